@@ -0,0 +1,326 @@
+
+from server import Server, Client, SETUP_WAIT_TIMEOUT
+from capi import DEFAULT_ENDPOINT, CONNECT_TIMEOUT, ssl_context
+from pool import CapiPool, POOL_RETRY_DELAY
+
+import asyncio
+import time
+
+import websocket
+
+try:
+    from websockets.asyncio.client import connect as ws_connect
+    from websockets.exceptions import ConnectionClosed, ConnectionClosedOK, WebSocketException
+    from websockets.protocol import State
+except ImportError:
+    ws_connect = None
+
+
+class StreamSocket(object):
+    # Presents an asyncio stream writer as the socket ThinBncsClient expects. Writing is done by AsyncServer._send_bncs.
+    def __init__(self, writer):
+        self.writer = writer
+
+    def shutdown(self, how):
+        self.writer.transport.abort()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncWebSocket(object):
+    # Presents an asyncio websocket as the websocket.WebSocket CapiClient expects.
+    #   Outgoing messages are queued and written in order by a single writer task.
+    def __init__(self, ws, owner):
+        self.ws = ws
+        self.owner = owner
+        self.connected = True
+
+        self._outbox = asyncio.Queue()
+        self._writer = asyncio.ensure_future(self._write_loop())
+
+    def send(self, data, opcode=websocket.ABNF.OPCODE_TEXT):
+        if not self.connected:
+            raise websocket.WebSocketConnectionClosedException("socket is already closed.")
+        self._outbox.put_nowait(data)
+
+    def ping(self, payload=''):
+        if not self.connected:
+            raise websocket.WebSocketConnectionClosedException("socket is already closed.")
+        asyncio.ensure_future(self._ping(payload))
+
+    def close(self):
+        # Anything already queued (such as a DisconnectRequest) is sent before the socket closes.
+        if self.connected:
+            self.connected = False
+            self._outbox.put_nowait(None)
+
+    async def _ping(self, payload):
+        try:
+            waiter = await self.ws.ping(payload)
+            await waiter
+        except ConnectionClosed:
+            return
+
+        # A pong counts as traffic, the same as in threaded mode.
+        self.owner.last_talk = time.monotonic()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                data = await self._outbox.get()
+                if data is None:
+                    break
+                await self.ws.send(data, text=True)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.connected = False
+            await self.ws.close()
+
+
+async def open_websocket(endpoint):
+    return await ws_connect(endpoint, ssl=ssl_context() if endpoint.startswith("wss") else None,
+                            open_timeout=CONNECT_TIMEOUT, compression=None, ping_interval=None, max_size=None)
+
+
+class AsyncCapiPool(CapiPool):
+    # The same pool, refilled by a task on the event loop instead of a thread
+    def __init__(self, endpoint, size):
+        super().__init__(endpoint, size)
+        self.wakeup = asyncio.Event()
+
+    def start(self):
+        asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            for ws in self._remove_stale():
+                self.discard(ws)
+
+            if len(self.idle) >= self.size:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self._next_expiry())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                ws = await open_websocket(self.endpoint)
+            except (OSError, asyncio.TimeoutError, WebSocketException):
+                self.failures += 1
+                await asyncio.sleep(POOL_RETRY_DELAY)
+                continue
+            self._add(ws)
+
+    def usable(self, ws):
+        return ws.state is State.OPEN
+
+    def discard(self, ws):
+        asyncio.ensure_future(ws.close())
+
+
+class AsyncServer(Server):
+    def __init__(self, port=6112, iface='', reuse_port=False):
+        if ws_connect is None:
+            raise RuntimeError("The asyncio server requires the 'websockets' package.")
+
+        super().__init__(port, iface, reuse_port)
+
+        # Maximum number of bytes taken from a BNCS stream at once
+        self.read_size = 65536
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.monitor = asyncio.ensure_future(self._run_timers())
+
+        if self.capi_pool_size > 0:
+            self.capi_pool = AsyncCapiPool(self.capi_endpoint or DEFAULT_ENDPOINT, self.capi_pool_size)
+            self.capi_pool.start()
+
+        self.setup_slots = asyncio.Semaphore(self.setup_workers)
+        server = await asyncio.start_server(self._handle_connection, sock=self.socket, backlog=self.backlog)
+        self.print("[Server] ThinBNCS server started (asyncio) - listening on port %i" % self.port)
+
+        async with server:
+            await server.serve_forever()
+
+    async def _run_timers(self):
+        wake = asyncio.Event()
+        self.scheduler.wakeup = wake.set
+
+        while True:
+            self.scheduler.run_due()
+
+            try:
+                await asyncio.wait_for(wake.wait(), self.scheduler.next_delay())
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+
+    def monitor_active(self):
+        return self.monitor is not None and not self.monitor.done()
+
+    async def _handle_connection(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        obj = Client(self, StreamSocket(writer), address, self.clients.reserve_id())
+        self.clients.add(obj)
+
+        obj.print("Connected from %s" % address[0])
+        obj.bncs.writer = asyncio.ensure_future(self._send_bncs(obj, writer))
+
+        if not self.admit(obj):
+            self.reject(obj)
+            return
+
+        try:
+            connected = await self._setup_client(obj)
+        finally:
+            self.setup_finished()
+
+        if connected is None:
+            self.reject(obj)
+        elif connected:
+            self.start_timers(obj)
+            asyncio.ensure_future(self._receive_capi(obj, obj.capi))
+            await self._receive_bncs(obj, reader)
+        else:
+            obj.close("Unable to connect to the chat API.")
+
+    async def _setup_client(self, client):
+        # Returns None if the client waited too long to start connecting to the chat API
+        try:
+            await asyncio.wait_for(self.setup_slots.acquire(), SETUP_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+
+        try:
+            return await self._connect_capi(client)
+        finally:
+            self.setup_slots.release()
+
+    async def _connect_capi(self, client):
+        capi = client.capi
+        ws = self.capi_pool.take() if self.capi_pool is not None else None
+        if ws is None:
+            try:
+                ws = await open_websocket(capi.endpoint)
+            except (OSError, asyncio.TimeoutError, WebSocketException):
+                return False
+
+        capi.attach(AsyncWebSocket(ws, capi))
+        return True
+
+    async def _receive_bncs(self, client, reader):
+        bncs = client.bncs
+        try:
+            # First byte from the client determines the protocol
+            if not bncs.select_protocol(await reader.read(1)):
+                return
+
+            while bncs.connected:
+                data = await reader.read(self.read_size)
+                if len(data) == 0:
+                    bncs.disconnect("Client closed the connection")
+                    return
+
+                if not bncs.feed(data):
+                    return
+        except (ConnectionError, TimeoutError) as ex:
+            bncs.disconnect("BNCS receive failed: %s" % ex)
+            return
+
+        bncs.disconnect("BNCS thread exited")
+
+    async def _send_bncs(self, client, writer):
+        queue = client.bncs.outbound
+        ready = asyncio.Event()
+        queue.wakeup = ready.set
+
+        try:
+            while True:
+                # The queue may have been flushed or closed before this task started
+                if not (queue.ready or queue.closed):
+                    await ready.wait()
+                ready.clear()
+
+                chunks = queue.take()
+                if chunks is None:
+                    break
+
+                if len(chunks) > 0:
+                    writer.write(b''.join(chunks))
+                    await writer.drain()
+        except (ConnectionError, TimeoutError) as ex:
+            client.close("BNCS send failed: %s" % ex)
+        finally:
+            writer.close()
+
+    async def _receive_capi(self, client, capi):
+        # The client can move to a shared session, so this keeps receiving for the one it started with.
+        #   If the connection is lost, it keeps reconnecting for as long as the session should.
+        while await self._receive_websocket(client, capi):
+            if not await self._reconnect_capi(capi):
+                return
+
+    async def _reconnect_capi(self, capi):
+        # Returns True once connected again, or False if the session has stopped reconnecting.
+        while True:
+            delay = capi.reconnect_delay()
+            if delay is None:
+                return False
+            await asyncio.sleep(delay)
+
+            if not capi.reconnecting:
+                return False
+            try:
+                ws = await open_websocket(capi.endpoint)
+            except (OSError, asyncio.TimeoutError, WebSocketException):
+                continue
+
+            if not capi.reconnecting:
+                # Every client left while connecting
+                await ws.close()
+                return False
+            capi.attach(AsyncWebSocket(ws, capi))
+            capi.resume()
+            return True
+
+    async def _receive_websocket(self, client, capi):
+        # Returns True if the connection was lost and the session is reconnecting.
+        loop = asyncio.get_running_loop()
+        held = False
+
+        def release():
+            nonlocal held
+            held = False
+            client.bncs.release()
+
+        try:
+            # Text frames are received as bytes so they can be parsed without decoding them first.
+            while True:
+                message = await capi.socket.ws.recv(decode=False)
+                capi.last_talk = time.monotonic()
+
+                # Messages that are already buffered are handled without yielding to the loop, so hold BNCS output
+                #   until the next loop iteration to send everything they produce together.
+                if not held:
+                    held = True
+                    client.bncs.hold()
+                    loop.call_soon(release)
+
+                capi.handle_message(message)
+
+                if not capi.connected():
+                    break
+        except ConnectionClosedOK:
+            pass
+        except ConnectionClosed as ex:
+            return capi.lost("CAPI receive failed: %s" % ex)
+
+        if not capi.reconnecting:
+            capi.finish()
+        return capi.reconnecting
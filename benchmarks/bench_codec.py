@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Compares the available JSON backends on chat API traffic.
+#   Traffic can be loaded from a file with one raw CAPI message per line, otherwise a typical mix is generated.
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+
+
+def generate_traffic(count):
+    encode = codec.dumps
+    messages = []
+    for i in range(count):
+        user_id = random.randint(2, 5000)
+        kind = random.random()
+        if kind < 0.6:
+            msg = {"command": "Botapichat.MessageEventRequest", "request_id": 0, "payload": {
+                "user_id": user_id, "type": "Channel", "message": "message number %i from user %i" % (i, user_id)}}
+        elif kind < 0.85:
+            msg = {"command": "Botapichat.UserUpdateEventRequest", "request_id": 0, "payload": {
+                "user_id": user_id, "toon_name": "User%i" % user_id, "flag": ["Speaker"],
+                "attribute": [{"key": "ProgramId", "value": "W3XP"}, {"key": "Rate", "value": "1"}]}}
+        elif kind < 0.95:
+            msg = {"command": "Botapichat.UserLeaveEventRequest", "request_id": 0, "payload": {"user_id": user_id}}
+        else:
+            msg = {"command": "Botapichat.SendMessageResponse", "request_id": i, "payload": {}}
+        messages.append(encode(msg))
+    return messages
+
+
+def load_traffic(path):
+    with open(path, 'rb') as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_codec')
+    parser.add_argument('traffic', nargs='?', help='File with one recorded CAPI message per line')
+    parser.add_argument('--count', type=int, default=20000, help='Number of messages to generate')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timing runs (best is reported)')
+    args = parser.parse_args()
+
+    default = codec.backend
+    messages = load_traffic(args.traffic) if args.traffic else generate_traffic(args.count)
+    size = sum(len(m) for m in messages)
+    print("Traffic: %i messages, %i bytes" % (len(messages), size))
+
+    for name in codec.available():
+        codec.use(name)
+        loads = codec.loads
+
+        decode = min(timeit.repeat(lambda: [loads(m) for m in messages], number=1, repeat=args.repeat))
+        encode = min(timeit.repeat(lambda: [codec.encode_request("Botapichat.SendMessageRequest", i, {"message": "hi"})
+                                            for i in range(len(messages))], number=1, repeat=args.repeat))
+
+        print("%-8s decode: %10.0f msg/s (%6.1f MB/s)   encode request: %10.0f msg/s" %
+              (name, len(messages) / decode, size / decode / 1e6, len(messages) / encode))
+
+    codec.use(default)
+
+
+if __name__ == '__main__':
+    main()
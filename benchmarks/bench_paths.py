@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Times the hot paths for packet encoding and channel state, with no network traffic.
+#   Results can be saved with --output and compared with a previous run with --compare, for example to check a change
+#   against the revision before it. Channel benchmarks run with 10, 1,000 and 10,000 users unless --sizes is given,
+#   and the memory held for each user in a channel of that size is also reported.
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bncs
+import buffer
+from server import Server, Client
+
+
+CHAT_TEXT = "The quick brown fox jumps over the lazy dog, then does it again just to make sure."
+
+
+def measure(func, ops, repeat):
+    """Returns the best time per operation, in seconds. Each call to func() should do 'ops' operations."""
+    return min(timeit.repeat(func, number=1, repeat=repeat)) / ops
+
+
+def make_server():
+    server = Server(0, '127.0.0.1')
+    server.queue_max_packets = 1 << 30
+    server.queue_max_bytes = 1 << 40
+    return server
+
+
+def make_client(server, users):
+    # A client that has entered a channel with 'users' other users in it. Its BNCS side never sends anything.
+    sock, _ = socket.socketpair()
+    client = Client(server, sock, ('127.0.0.1', 0), server.clients.reserve_id())
+    server.clients.add(client)
+
+    capi = client.capi
+    capi.enter_chat(client)
+    capi.username = "BenchBot"
+    capi.channel = "Bench"
+    capi._received_users = True
+    for user_id in range(2, users + 2):
+        capi._handle_user_update_event(None, user_payload(user_id, []), None)
+    client.bncs.outbound.take()
+    return client
+
+
+def user_payload(user_id, flags):
+    return {"user_id": user_id, "toon_name": "User%i" % user_id, "flag": flags,
+            "attribute": [{"key": "ProgramId", "value": "W3XP"}]}
+
+
+def bench_buffers(results, args):
+    def write_chat_event():
+        for _ in range(1000):
+            pak = bncs.PacketBuffer()
+            pak.insert_struct(bncs.CHATEVENT_HEADER, bncs.EID_TALK, 0, 0, 0, 0xbaadf00d, 0xbaadf00d)
+            pak.insert_string("User1234")
+            pak.insert_string(CHAT_TEXT)
+            pak.finish(bncs.SID_CHATEVENT)
+    results["DataBuffer.chat_event"] = measure(write_chat_event, 1000, args.repeat)
+
+    pak = buffer.DataBuffer()
+    for i in range(8):
+        pak.insert_dword(i)
+    pak.insert_string("USA")
+    pak.insert_string("United States")
+    data = bytes(pak.data)
+
+    def read_auth_info():
+        for _ in range(1000):
+            reader = buffer.DataReader(data)
+            for i in range(8):
+                reader.get_dword()
+            reader.get_string()
+            reader.get_string()
+    results["DataReader.auth_info"] = measure(read_auth_info, 1000, args.repeat)
+
+    dump = bytes(random.getrandbits(8) for _ in range(256))
+    results["format_buffer.256_bytes"] = measure(lambda: buffer.format_buffer(dump), 1, args.repeat * 20)
+
+
+def bench_send_chat(results, args, server):
+    client = make_client(server, 0)
+    bncs_client = client.bncs
+
+    def send_chat():
+        for _ in range(1000):
+            bncs_client.send_chat(bncs.EID_TALK, "User1234", CHAT_TEXT, 0)
+        bncs_client.outbound.take()
+    results["send_chat.talk"] = measure(send_chat, 1000, args.repeat)
+    client.close()
+
+
+def bench_channel(results, args, server, size):
+    client = make_client(server, size)
+    capi = client.capi
+    user_ids = list(range(2, size + 2))
+    names = ["user%i" % i for i in user_ids]
+    batch = min(size, 1000)
+
+    def get_by_id():
+        for i in range(1000):
+            capi.get_user(user_ids[i % size])
+    results["get_user.id.%i" % size] = measure(get_by_id, 1000, args.repeat)
+
+    def get_by_name():
+        for i in range(1000):
+            capi.get_user(names[i % size])
+    results["get_user.name.%i" % size] = measure(get_by_name, 1000, args.repeat)
+
+    # Chat lines from users in the channel
+    messages = [{"user_id": user_ids[i % size], "type": "Channel", "message": CHAT_TEXT} for i in range(1000)]
+
+    def relay_messages():
+        for payload in messages:
+            capi._handle_message_event(None, payload, None)
+        client.bncs.outbound.take()
+    results["message_event.%i" % size] = measure(relay_messages, 1000, args.repeat)
+
+    # Flag changes for users already in the channel
+    flags = [["Speaker"], ["Speaker", "MuteGlobal"]]
+    updates = [[user_payload(user_id, f) for user_id in user_ids[:batch]] for f in flags]
+    state = [0]
+
+    def update_users():
+        state[0] ^= 1
+        for payload in updates[state[0]]:
+            capi._handle_user_update_event(None, payload, None)
+        client.bncs.outbound.take()
+    results["user_update.change.%i" % size] = measure(update_users, batch, args.repeat)
+
+    # Leaves and joins are timed separately, each undoing the other between runs.
+    joins = [user_payload(user_id, []) for user_id in user_ids[:batch]]
+    leaves = [{"user_id": user_id} for user_id in user_ids[:batch]]
+    leave_times, join_times = [], []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        for payload in leaves:
+            capi._handle_user_leave_event(None, payload, None)
+        leave_times.append(time.perf_counter() - started)
+        client.bncs.outbound.take()
+
+        started = time.perf_counter()
+        for payload in joins:
+            capi._handle_user_update_event(None, payload, None)
+        join_times.append(time.perf_counter() - started)
+        client.bncs.outbound.take()
+
+    results["user_leave.%i" % size] = min(leave_times) / batch
+    results["user_update.join.%i" % size] = min(join_times) / batch
+    client.close()
+
+
+def measure_users(server, size):
+    # Bytes held for each user in a channel of 'size' users, including the lookup tables
+    client = make_client(server, 0)
+    capi = client.capi
+    payloads = [user_payload(user_id, ["Speaker"] if user_id % 10 == 0 else []) for user_id in range(2, size + 2)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for payload in payloads:
+        capi._handle_user_update_event(None, payload, None)
+    client.bncs.outbound.take()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    client.close()
+    return used / size
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_paths')
+    parser.add_argument('--sizes', default='10,1000,10000', help='Comma-separated channel sizes to test')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timing runs (best is reported)')
+    parser.add_argument('--filter', help='Only shows benchmarks with names containing this text')
+    parser.add_argument('--output', help='Saves the results to this JSON file')
+    parser.add_argument('--compare', help='Compares the results with a JSON file saved by a previous run')
+    args = parser.parse_args()
+
+    random.seed(0)
+    server = make_server()
+    server.print = lambda text: None
+    server.write_client_message = lambda client, text, debug=False: None
+
+    results = {}
+    memory = {}
+    bench_buffers(results, args)
+    bench_send_chat(results, args, server)
+    for size in [int(s) for s in args.sizes.split(',')]:
+        bench_channel(results, args, server, size)
+        memory["user_memory.%i" % size] = measure_users(server, size)
+    server.socket.close()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+        print("Compared with %s (revision %s), positive is faster" %
+              (args.compare, previous.get("revision") or "unknown"))
+
+    for name, seconds in results.items():
+        if args.filter and args.filter not in name:
+            continue
+
+        line = "%-28s %10.3f us/op %12.0f ops/s" % (name, seconds * 1e6, 1 / seconds)
+        old = previous and previous["results"].get(name)
+        if old:
+            line += "   %+6.1f%%" % ((old / seconds - 1) * 100)
+        print(line)
+
+    for name, size in memory.items():
+        if args.filter and args.filter not in name:
+            continue
+
+        line = "%-28s %10.0f bytes/user" % (name, size)
+        old = previous and previous.get("memory", {}).get(name)
+        if old:
+            line += "%25s%+6.1f%%" % ('', (old / size - 1) * 100)
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({
+                "revision": git_revision(),
+                "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                "python": platform.python_version(),
+                "results": results,
+                "memory": memory
+            }, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
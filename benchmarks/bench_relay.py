@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Measures how fast the proxy relays chat API events to BNCS clients, from end to end.
+#   The mock chat API (mock_capi.py) and the proxy (main.py) are started as separate processes. Each bot connects to
+#   the proxy, logs on, enters chat and counts the chat events it receives until the mock's flood ends. Reported
+#   latency is the time from the mock sending a chat message to a bot receiving it.
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import bncs
+import buffer
+from mock_capi import END_MARKER
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def packet(pid, data=b''):
+    return bncs.HEADER.pack(0xFF, pid, len(data) + bncs.HEADER.size) + data
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0.0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+class BenchBot(object):
+    """A minimal BNCS client that logs on and counts the chat events it receives."""
+    def __init__(self, number):
+        self.number = number
+        self.events = 0
+        self.latencies = []
+        self.first_event = None
+        self.last_event = None
+        self.finished = False
+        self.error = None
+
+    async def run(self, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(b'\x01' + packet(bncs.SID_AUTH_INFO, bytes(8) + b'LTRD' + bytes(24) + b'USA\0United States\0'))
+            writer.write(packet(bncs.SID_LOGONRESPONSE2, bytes(28) + b'bench-key-%i\0' % self.number))
+            await writer.drain()
+
+            data = b''
+            while not self.finished:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    self.error = "Connection closed by the proxy"
+                    return
+
+                data += chunk
+                pos = 0
+                while len(data) - pos >= 4:
+                    _, pid, length = bncs.HEADER.unpack_from(data, pos)
+                    if len(data) - pos < length:
+                        break
+                    self.handle_packet(pid, data[(pos + 4):(pos + length)], writer)
+                    pos += length
+                data = data[pos:]
+        except (ConnectionError, OSError) as ex:
+            self.error = str(ex)
+        finally:
+            writer.close()
+
+    def handle_packet(self, pid, data, writer):
+        if pid == bncs.SID_LOGONRESPONSE2:
+            if buffer.DWORD.unpack_from(data)[0] != 0:
+                raise ConnectionError("Logon failed")
+            writer.write(packet(bncs.SID_ENTERCHAT, b'\0\0'))
+
+        elif pid == bncs.SID_CHATEVENT:
+            eid = buffer.DWORD.unpack_from(data)[0]
+            if eid not in [bncs.EID_TALK, bncs.EID_USERFLAGS]:
+                return
+
+            now = time.monotonic()
+            username, text = data[bncs.CHATEVENT_HEADER.size:].split(b'\0')[:2]
+            if eid == bncs.EID_TALK:
+                if text == END_MARKER.encode():
+                    self.finished = True
+                    return
+
+                sent = float(text.split(b' ')[1])
+                self.latencies.append(now - sent)
+
+            self.events += 1
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+
+
+async def wait_for_port(port, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Process exited with code %i" % process.returncode)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Timed out waiting for port %i" % port)
+
+
+async def run_bots(args, bncs_port, capi_port, mock, proxy):
+    await wait_for_port(capi_port, mock)
+    await wait_for_port(bncs_port, proxy)
+
+    bots = [BenchBot(i) for i in range(args.bots)]
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.gather(*[bot.run(bncs_port) for bot in bots]), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    return bots, time.monotonic() - started
+
+
+def summarize(args, bots, elapsed):
+    events = sum(bot.events for bot in bots)
+    firsts = [bot.first_event for bot in bots if bot.first_event is not None]
+    lasts = [bot.last_event for bot in bots if bot.last_event is not None]
+    duration = (max(lasts) - min(firsts)) if firsts else 0
+    latencies = sorted(lat for bot in bots for lat in bot.latencies)
+
+    return {
+        "engine": "asyncio" if args.asyncio else "threads",
+        "bots": args.bots,
+        "users": args.users,
+        "messages_per_bot": args.messages,
+        "bots_finished": sum(1 for bot in bots if bot.finished),
+        "errors": sorted(set(bot.error for bot in bots if bot.error)),
+        "events": events,
+        "seconds": round(duration, 3),
+        "events_per_second": round(events / duration, 1) if duration > 0 else 0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round((latencies[-1] if latencies else 0) * 1000, 2)
+        },
+        "total_seconds": round(elapsed, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_relay')
+    parser.add_argument('--bots', type=int, default=10, help='Number of bots to connect')
+    parser.add_argument('--users', type=int, default=100, help='Number of other users in each channel')
+    parser.add_argument('--messages', type=int, default=5000, help='Number of events sent to each bot')
+    parser.add_argument('--rate', type=float, default=0, help='Events per second for each bot (0 for no limit)')
+    parser.add_argument('--update-ratio', type=float, default=0.1, help='Fraction of events that are user updates')
+    parser.add_argument('--asyncio', action='store_true', help='Runs the proxy with the asyncio engine')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for every bot to finish')
+    parser.add_argument('--json', help='Saves the results to this file')
+    args = parser.parse_args()
+
+    capi_port, bncs_port = free_port(), free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join(HERE, 'mock_capi.py'), '--port', str(capi_port),
+                             '--users', str(args.users), '--messages', str(args.messages), '--rate', str(args.rate),
+                             '--update-ratio', str(args.update_ratio)], stdout=subprocess.DEVNULL)
+
+    proxy_args = [sys.executable, os.path.join(os.path.dirname(HERE), 'main.py'),
+                  '--interface', '127.0.0.1:%i' % bncs_port, '--capi-endpoint', 'ws://127.0.0.1:%i' % capi_port]
+    if args.asyncio:
+        proxy_args.append('--asyncio')
+    proxy = subprocess.Popen(proxy_args, stdout=subprocess.DEVNULL)
+
+    try:
+        bots, elapsed = asyncio.run(run_bots(args, bncs_port, capi_port, mock, proxy))
+    finally:
+        for process in [proxy, mock]:
+            process.terminate()
+            process.wait()
+
+    results = summarize(args, bots, elapsed)
+    print("%s: %i bots, %i users, %i events in %.2fs = %.0f events/s (%i of %i bots finished)" %
+          (results["engine"], args.bots, args.users, results["events"], results["seconds"],
+           results["events_per_second"], results["bots_finished"], args.bots))
+    print("CAPI -> BNCS latency: p50 %(p50).2fms, p90 %(p90).2fms, p99 %(p99).2fms, max %(max).2fms" %
+          results["latency_ms"])
+    for error in results["errors"]:
+        print("Error: %s" % error)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the chat API, for testing and benchmarking without connecting to Battle.net.
+#   Any API key is accepted. After entering chat, each connection gets a channel of --users users and then a flood
+#   of --messages events. Chat messages in the flood carry the time they were sent ("<seq> <monotonic time>"), so the
+#   relay latency can be measured on the same machine, and the flood ends with a message saying "bench end".
+#
+#   Requires the 'websockets' package.
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+
+BOT_USER_ID = 1
+END_MARKER = "bench end"
+
+products = ["W3XP", "WAR3", "D2XP", "D2DV", "SEXP", "STAR", "W2BN"]
+
+
+def event(command, payload):
+    return json.dumps({"command": command, "request_id": 0, "payload": payload})
+
+
+def user_update(user_id, name, flags, product):
+    return event("Botapichat.UserUpdateEventRequest", {
+        "user_id": user_id, "toon_name": name, "flag": flags,
+        "attribute": [{"key": "ProgramId", "value": product}]
+    })
+
+
+def message_event(user_id, message, mtype="Channel"):
+    return event("Botapichat.MessageEventRequest", {"user_id": user_id, "type": mtype, "message": message})
+
+
+class MockSession(object):
+    """The chat API's side of one bot connection."""
+    def __init__(self, ws, options):
+        self.ws = ws
+        self.options = options
+        self.users = {}         # user_id -> [name, flags, product]
+        self.in_chat = False
+        self.sent_times = []    # For the send rate limit
+
+        self.handlers = {
+            "Botapiauth.AuthenticateRequest": self.handle_authenticate,
+            "Botapichat.ConnectRequest": self.handle_connect,
+            "Botapichat.DisconnectRequest": self.handle_disconnect,
+            "Botapichat.SendMessageRequest": self.handle_send_message,
+            "Botapichat.SendEmoteRequest": self.handle_send_message,
+            "Botapichat.SendWhisperRequest": self.handle_send_whisper,
+            "Botapichat.BanUserRequest": self.handle_remove_user,
+            "Botapichat.KickUserRequest": self.handle_remove_user,
+            "Botapichat.UnbanUserRequest": self.handle_other,
+            "Botapichat.SendSetModeratorRequest": self.handle_other
+        }
+
+    async def respond(self, request, payload=None, area=0, code=0):
+        msg = {"command": request["command"].replace("Request", "Response"), "request_id": request["request_id"],
+               "payload": payload or {}}
+        if area or code:
+            msg["status"] = {"area": area, "code": code}
+        await self.ws.send(json.dumps(msg))
+
+    async def run(self):
+        try:
+            async for data in self.ws:
+                try:
+                    request = json.loads(data)
+                except ValueError:
+                    continue
+
+                handler = self.handlers.get(request.get("command"))
+                if handler is None:
+                    await self.respond(request, area=8, code=2)     # Bad request
+                else:
+                    await handler(request)
+        except ConnectionClosed:
+            pass
+
+    async def handle_authenticate(self, request):
+        await self.respond(request)
+
+    async def handle_connect(self, request):
+        if self.in_chat:
+            await self.respond(request, area=8, code=2)
+            return
+
+        self.in_chat = True
+        await self.respond(request)
+
+        # Our own info comes first, then the channel and everyone in it.
+        await self.ws.send(user_update(BOT_USER_ID, self.options.bot_name, [], "CHAT"))
+        await self.ws.send(event("Botapichat.ConnectEventRequest", {"channel": self.options.channel}))
+
+        for user_id in range(2, self.options.users + 2):
+            user = self.users[user_id] = ["User%i" % user_id, ["Moderator"] if user_id == 2 else [],
+                                          random.choice(products)]
+            await self.ws.send(user_update(user_id, *user))
+        if self.options.empty_flags:
+            await self.ws.send(event("Botapichat.UserUpdateEventRequest", {"user_id": BOT_USER_ID, "flag": []}))
+        else:
+            await self.ws.send(event("Botapichat.UserUpdateEventRequest", {"user_id": BOT_USER_ID}))
+
+        asyncio.ensure_future(self.flood())
+
+    async def flood(self):
+        opts = self.options
+        delay = (1 / opts.rate) if opts.rate > 0 else 0
+        user_ids = list(self.users.keys()) or [BOT_USER_ID]
+
+        try:
+            for seq in range(opts.messages):
+                user_id = random.choice(user_ids)
+                if user_id not in self.users and user_id != BOT_USER_ID:
+                    continue        # Kicked or banned since the flood started
+                elif user_id != BOT_USER_ID and random.random() < opts.update_ratio:
+                    # Toggle a squelch flag. With --empty-flags, the other state has no flags at all.
+                    user = self.users[user_id]
+                    base = [] if opts.empty_flags else ["Speaker"]
+                    user[1] = base if user[1] == base + ["MuteGlobal"] else base + ["MuteGlobal"]
+                    await self.ws.send(user_update(user_id, *user))
+                else:
+                    await self.ws.send(message_event(user_id, "%i %.6f" % (seq, time.monotonic())))
+
+                if delay:
+                    await asyncio.sleep(delay)
+                elif seq % 100 == 0:
+                    # Let other connections have a turn
+                    await asyncio.sleep(0)
+
+            if opts.messages > 0:
+                await self.ws.send(message_event(BOT_USER_ID, END_MARKER))
+        except ConnectionClosed:
+            pass
+
+    async def handle_disconnect(self, request):
+        await self.respond(request)
+        await self.ws.close()
+
+    def rate_limited(self):
+        if self.options.send_limit <= 0:
+            return False
+
+        now = time.monotonic()
+        self.sent_times = [t for t in self.sent_times if now - t < 1] + [now]
+        return len(self.sent_times) > self.options.send_limit
+
+    async def handle_send_message(self, request):
+        if self.rate_limited():
+            await self.respond(request, area=6, code=8)
+            return
+
+        await self.respond(request)
+        mtype = "Emote" if request["command"] == "Botapichat.SendEmoteRequest" else "Channel"
+        await self.ws.send(message_event(BOT_USER_ID, request["payload"].get("message", ''), mtype))
+
+    async def handle_send_whisper(self, request):
+        if self.rate_limited():
+            await self.respond(request, area=6, code=8)
+        elif request["payload"].get("user_id") not in self.users:
+            await self.respond(request, area=8, code=2)
+        else:
+            await self.respond(request)
+
+    async def handle_remove_user(self, request):
+        user_id = request["payload"].get("user_id")
+        if user_id not in self.users:
+            await self.respond(request, area=8, code=2)
+            return
+
+        await self.respond(request)
+        del self.users[user_id]
+        await self.ws.send(event("Botapichat.UserLeaveEventRequest", {"user_id": user_id}))
+
+    async def handle_other(self, request):
+        await self.respond(request)
+
+
+async def serve_forever(options):
+    async def handler(ws):
+        await MockSession(ws, options).run()
+
+    async with serve(handler, options.host, options.port, compression=None, max_size=None):
+        print("Mock chat API listening on ws://%s:%i" % (options.host, options.port), flush=True)
+        await asyncio.Future()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='mock_capi')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--users', type=int, default=10, help='Number of other users in the channel')
+    parser.add_argument('--messages', type=int, default=0, help='Number of events to send after entering chat')
+    parser.add_argument('--rate', type=float, default=0, help='Events per second, per connection (0 for no limit)')
+    parser.add_argument('--update-ratio', type=float, default=0.1, help='Fraction of events that are user updates')
+    parser.add_argument('--send-limit', type=int, default=0,
+                        help='Messages per second a bot can send before hitting the rate limit (0 for no limit)')
+    parser.add_argument('--empty-flags', action='store_true',
+                        help='Send "flag": [] where flags are empty instead of leaving it out')
+    parser.add_argument('--channel', default='Bench Test', help='Name of the channel')
+    parser.add_argument('--bot-name', default='BenchBot', help="The bot's own name")
+    return parser
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve_forever(get_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
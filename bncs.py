@@ -1,10 +1,13 @@
 
 import buffer
 
-from threading import Thread
-from datetime import datetime
+from threading import Thread, RLock, Condition
+from collections import deque
+from socket import SHUT_RDWR, SHUT_WR
+from struct import Struct, unpack_from
 import random
 import json
+import time
 
 
 protocols = [
@@ -13,6 +16,9 @@ protocols = [
 
 products = ["STAR", "SEXP", "D2DV", "D2XP", "WAR3", "W3XP", "W2BN", "DRTL", "DSHR"]
 
+LINGER_TIMEOUT = 5      # Seconds to wait for a turned away client to close its end of the connection
+CLOSE_TIMEOUT = 10      # Seconds a closed client has to take the packets still queued for it
+
 check_revision_data = (0x0000000000000000, "ver-IX86-1.mpq", "C=10 A=20 B=30 4 A=A-S B=B+C C=C^A A=A^B")
 
 unsupported_commands = ["away", "dnd", "friends", "options", "squelch", "unsquelch", "who", "whoami", "whois",
@@ -62,6 +68,261 @@ GATEWAY_USER = "CAPI Gateway"
 
 IGNORE_PACKETS = [SID_NULL, SID_PING]
 
+HEADER = Struct('<BBH')
+CHATEVENT_HEADER = Struct('<6L')    # EID, flags, ping, IP address, account number, registration authority
+CHATEVENT_PACKET = Struct('<BBH6L')     # Packet header followed by the chat event header
+
+
+class PacketBuffer(buffer.DataBuffer):
+    # A data buffer with room left at the start for the packet header, so sending it needs no extra copy.
+    def __init__(self, size=64):
+        super().__init__(size, HEADER.size)
+
+    def finish(self, pid):
+        # Fills in the header and returns the complete packet
+        self.patch(HEADER, 0, 0xFF, pid, len(self))
+        return self.data
+
+
+def chat_event(eid, username, text, flags=0, ping=0, encoding='utf-8', errors=None):
+    """Returns a complete SID_CHATEVENT packet. The username and text can be given already encoded, as bytes."""
+    # Chat events are most of what gets sent, so they're put together in one step instead of with a PacketBuffer.
+    if not isinstance(username, bytes):
+        username = username.encode('utf-8')
+    if not isinstance(text, bytes):
+        text = text.encode(encoding, errors or 'strict')
+
+    length = CHATEVENT_PACKET.size + len(username) + len(text) + 2
+    header = CHATEVENT_PACKET.pack(0xFF, SID_CHATEVENT, length, eid, flags, ping, 0, 0xbaadf00d, 0xbaadf00d)
+    return b''.join([header, username, b'\0', text, b'\0'])
+
+
+def _build_static_packets():
+    packets = {SID_NULL: PacketBuffer()}
+
+    pak = packets[SID_CLIENTID] = PacketBuffer()
+    pak.insert_dword(0)
+    pak.insert_dword(0)
+    pak.insert_dword(0)
+    pak.insert_dword(0)
+
+    pak = packets[SID_REPORTVERSION] = PacketBuffer()
+    pak.insert_dword(0x02)      # Result: success
+    pak.insert_string('')       # Patch path
+
+    pak = packets[SID_AUTH_CHECK] = PacketBuffer()
+    pak.insert_dword(0x00)      # Success
+    pak.insert_string('')
+
+    pak = packets[SID_CDKEY2] = PacketBuffer()
+    pak.insert_dword(0x01)      # Result: OK
+    pak.insert_string('')
+
+    pak = packets[SID_QUERYREALMS2] = PacketBuffer()
+    pak.insert_dword(0)
+    pak.insert_dword(0)
+
+    pak = packets[SID_GETICONDATA] = PacketBuffer()
+    pak.insert_long(0)
+    pak.insert_string('icons.bni')
+
+    return {pid: bytes(pak.finish(pid)) for pid, pak in packets.items()}
+
+
+# Responses that are the same for every client, serialized once.
+static_packets = _build_static_packets()
+
+
+class PacketDecoder(object):
+    """Collects received bytes and splits them into complete BNCS packets."""
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.error = None
+
+    def _reserve(self, size):
+        # Grows the buffer so that it can hold at least 'size' bytes
+        if size > len(self.buffer):
+            new_size = len(self.buffer)
+            while new_size < size:
+                new_size *= 2
+
+            data = bytearray(new_size)
+            data[:self.length] = self.view[:self.length]
+            self.buffer = data
+            self.view = memoryview(self.buffer)
+
+    def recv_into(self, sock):
+        # Reads directly from the socket into the free space at the end of the buffer
+        if self.length == len(self.buffer):
+            self._reserve(self.length * 2)
+
+        count = sock.recv_into(self.view[self.length:])
+        self.length += count
+        return count
+
+    def feed(self, data):
+        self._reserve(self.length + len(data))
+        self.view[self.length:self.length + len(data)] = data
+        self.length += len(data)
+
+    def packets(self):
+        """Yields (pid, DataReader) for each complete packet in the buffer.
+
+        Incomplete data is kept for the next read. If an invalid header is found, 'error' is set and nothing more
+        will be returned.
+        """
+        pos = 0
+        try:
+            while self.error is None and (self.length - pos) >= 4:
+                if self.buffer[pos] != 0xFF:
+                    self.error = "Invalid BNCS packet header"
+                    return
+
+                pid = self.buffer[pos + 1]
+                length = unpack_from('<H', self.buffer, pos + 2)[0]
+                if length < 4:
+                    self.error = "Invalid BNCS packet length"
+                    return
+
+                if (self.length - pos) < length:
+                    # Wait for the rest of this packet
+                    self._reserve(length)
+                    break
+
+                # The reader shares the receive buffer, so it is only valid until the next read.
+                pak = buffer.DataReader(self.buffer, pos, length)
+                pak.skip(HEADER.size)
+                pos += length
+                yield pid, pak
+        finally:
+            # Move any partial packet to the front of the buffer
+            if pos > 0:
+                remaining = self.length - pos
+                # Copied from a slice, since the view shares memory with the buffer and the two ranges can overlap
+                self.buffer[:remaining] = self.buffer[pos:self.length]
+                self.length = remaining
+
+
+class OutboundQueue(object):
+    """Packets waiting to be written to a BNCS client by its writer.
+
+    Once more than max_bytes or max_packets are waiting the client is considered to be falling behind, and the policy
+    decides what happens to new packets:
+        disconnect - put() fails and the client should be dropped
+        drop       - optional packets (chat messages, keep-alives) are discarded
+        coalesce   - like drop, but a packet with the same key as a waiting one replaces it instead of being added
+    With drop or coalesce, put() still fails once twice the limit is reached.
+    """
+    policies = ["disconnect", "drop", "coalesce"]
+
+    def __init__(self, max_bytes=262144, max_packets=4096, policy="disconnect"):
+        if policy not in self.policies:
+            raise ValueError("Invalid queue policy - must be %s" % ', '.join(self.policies))
+
+        self.max_bytes = max_bytes
+        self.max_packets = max_packets
+        self.policy = policy
+
+        self.lock = Condition()
+        self.entries = deque()
+        self.keys = {}
+        self.size = 0
+        self.ready = False
+        self.closed = False
+        self.wakeup = None      # Called when data is ready, for writers that don't wait on the lock
+
+        self.sent_bytes = 0
+        self.sent_packets = 0
+        self.peak_bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def over_limit(self, factor=1):
+        return self.size >= (self.max_bytes * factor) or len(self.entries) >= (self.max_packets * factor)
+
+    def put(self, data, key=None, optional=False):
+        # Returns False if the client has fallen too far behind to accept the packet.
+        with self.lock:
+            if self.closed:
+                return False
+
+            if self.over_limit():
+                if self.policy == "disconnect":
+                    return False
+
+                if self.policy == "coalesce" and key in self.keys:
+                    entry = self.keys[key]
+                    self.size += len(data) - len(entry[1])
+                    entry[1] = data
+                    self.coalesced += 1
+                    return True
+
+                if optional:
+                    self.dropped += 1
+                    return True
+
+                if self.over_limit(2):
+                    return False
+
+            entry = [key, data]
+            self.entries.append(entry)
+            if key is not None:
+                self.keys[key] = entry
+
+            self.size += len(data)
+            self.peak_bytes = max(self.peak_bytes, self.size)
+            return True
+
+    def flush(self):
+        # Lets the writer have everything that has been queued so far.
+        with self.lock:
+            if len(self.entries) > 0 and not self.ready:
+                self.ready = True
+                self.lock.notify()
+                if self.wakeup:
+                    self.wakeup()
+
+    def close(self, discard=False):
+        with self.lock:
+            if discard:
+                self.entries.clear()
+                self.keys.clear()
+                self.size = 0
+
+            self.closed = True
+            self.lock.notify()
+            if self.wakeup:
+                self.wakeup()
+
+    def take(self):
+        """Returns the data for every waiting packet, or None once the queue is closed and empty."""
+        with self.lock:
+            if len(self.entries) == 0:
+                self.ready = False
+                return None if self.closed else []
+
+            chunks = [entry[1] for entry in self.entries]
+            self.sent_packets += len(chunks)
+            self.sent_bytes += self.size
+
+            self.entries.clear()
+            self.keys.clear()
+            self.size = 0
+            self.ready = False
+            return chunks
+
+    def wait(self):
+        # Blocks until data is ready, then takes it.
+        with self.lock:
+            while not (self.ready or self.closed):
+                self.lock.wait()
+            return self.take()
+
 
 class ThinBncsClient(Thread):
     def __init__(self, parent, socket):
@@ -75,7 +336,12 @@ class ThinBncsClient(Thread):
         self.username = None
 
         self.logon_type = 0
-        self.last_talk = datetime.now()
+        self.last_talk = time.monotonic()
+
+        # Running totals, for metrics. Sent packets are counted by the outbound queue.
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.handler_time = 0.0
 
         self._handlers = {
             # Modern version checking
@@ -107,6 +373,18 @@ class ThinBncsClient(Thread):
         random.seed()
         self._server_token = random.getrandbits(32)
         self._client_token = None
+        self._decoder = PacketDecoder()
+
+        # Outgoing packets wait here for the writer. They are held back while sending is held.
+        server = parent.server
+        self.outbound = OutboundQueue(server.queue_max_bytes, server.queue_max_packets, server.queue_policy)
+        self.writer = None
+        self.linger = False         # Set to let the client read everything before the connection is closed
+
+        self._send_lock = RLock()
+        self._hold_count = 0
+        self._held_bytes = 0
+        self._held_since = None
 
         super().__init__()
         self.daemon = True
@@ -114,101 +392,222 @@ class ThinBncsClient(Thread):
     def disconnect(self, reason=None):
         self.parent.close(reason)
 
-    def send(self, pid, payload=None):
+    def close(self):
+        # Packets that are already queued are still written unless the client has fallen behind.
+        self.connected = False
+        discard = self.outbound.over_limit()
+        self.outbound.close(discard)
+
+        if discard or self.writer is None:
+            try:
+                self.socket.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        else:
+            # A client that has stopped reading would keep the writer blocked, so it only gets so long.
+            self.parent.server.scheduler.call_later(CLOSE_TIMEOUT, self._abort)
+
+    def _abort(self):
+        # Timer callback that cuts off the connection if the writer hasn't finished by now. This wakes up a blocked
+        #   writer, which then closes the socket itself.
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        return None
+
+    def send(self, pid, payload=None, key=None, optional=False):
         if not self.connected:
             return False
 
-        pak = buffer.DataBuffer()
-        pak.insert_byte(0xFF)
-        pak.insert_byte(pid)
-
-        if payload:
-            pak.insert_word(len(payload) + 4)
-            pak.insert_raw(payload.data if isinstance(payload, buffer.DataBuffer) else payload)
+        if isinstance(payload, PacketBuffer):
+            pak = payload
         else:
-            pak.insert_word(4)
+            pak = PacketBuffer()
+            if payload:
+                pak.insert_raw(payload.data if isinstance(payload, buffer.DataBuffer) else payload)
+
+        return self._write(pid, pak.finish(pid), key, optional)
+
+    def send_static(self, pid):
+        # Sends a prebuilt response from static_packets
+        return self._write(pid, static_packets[pid])
+
+    def hold(self):
+        # Keeps outgoing packets queued until release() is called so they can be sent together.
+        with self._send_lock:
+            self._hold_count += 1
+
+    def release(self):
+        with self._send_lock:
+            self._hold_count -= 1
+            if self._hold_count == 0:
+                self.flush()
+
+    def flush(self):
+        with self._send_lock:
+            self._held_bytes = 0
+            self._held_since = None
+            self.outbound.flush()
+
+    def _write(self, pid, data, key=None, optional=False):
+        if not self.connected:
+            return False
 
-        try:
-            self.socket.sendall(pak.data)
-        except (ConnectionError, TimeoutError) as ex:
-            self.parent.close("BNCS send failed: %s" % ex)
+        if not self.outbound.put(data, key, optional or pid in IGNORE_PACKETS):
+            self.parent.close("BNCS client is not keeping up (%i packets, %i bytes queued)" %
+                              (len(self.outbound), self.outbound.size))
             return False
 
+        with self._send_lock:
+            if self._hold_count > 0:
+                if self._held_since is None:
+                    self._held_since = time.monotonic()
+                self._held_bytes += len(data)
+
+                # Don't let held packets grow too large or wait too long
+                server = self.parent.server
+                if self._held_bytes >= server.flush_threshold or \
+                        (time.monotonic() - self._held_since) >= server.flush_delay:
+                    self.flush()
+            else:
+                self.outbound.flush()
+
         if pid not in IGNORE_PACKETS:
-            self.parent.debug("Sent BNCS packet 0x%02x (len: %i)" % (pid, len(pak)))
+            self.parent.debug("Sent BNCS packet 0x%02x (len: %i)", pid, len(data))
 
         return True
 
-    def receive(self):
-        if not self.connected:
-            return None, None
+    def start_writer(self):
+        self.writer = Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
 
-        try:
-            # Get packet header
-            header = self.socket.recv(4)
-            if len(header) == 4:
-                pak = buffer.DataReader(header)
-                if pak.get_byte() != 0xFF:
-                    self.disconnect("Invalid BNCS packet header")
-                    return None, pak
+    def _write_loop(self):
+        # Writes queued packets to the socket so that a slow client only blocks this thread.
+        while True:
+            chunks = self.outbound.wait()
+            if chunks is None:
+                break
 
-                pid = pak.get_byte()
-                length = pak.get_word()
+            try:
+                self.socket.sendall(b''.join(chunks))
+            except OSError as ex:
+                self.parent.close("BNCS send failed: %s" % ex)
+                break
 
-                if length > 4:
-                    pak.data += self.socket.recv(length - 4)
+        # Shutting down first also wakes the receiving thread
+        try:
+            if self.linger:
+                self._linger()
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def _linger(self):
+        # Closing with received data that hasn't been read resets the connection, and the client may lose what was sent
+        #   to it. So the client is left to close its end first, with anything it sends being thrown away.
+        #   A client that keeps sending is only given LINGER_TIMEOUT in total.
+        self.socket.shutdown(SHUT_WR)
+        deadline = time.monotonic() + LINGER_TIMEOUT
+        remaining = LINGER_TIMEOUT
+        while remaining > 0:
+            self.socket.settimeout(remaining)
+            if not self.socket.recv(4096):
+                break
+            remaining = deadline - time.monotonic()
 
-                if pid not in IGNORE_PACKETS:
-                    self.parent.debug("Received BNCS packet 0x%02x (len: %i)" % (pid, length))
+    def receive(self):
+        # Reads from the socket and handles every complete packet. Returns False once the connection is closed.
+        if not self.connected:
+            return False
 
-                self.last_talk = datetime.now()
-                return pid, pak
-            else:
+        try:
+            if self._decoder.recv_into(self.socket) == 0:
                 self.disconnect("Client closed the connection")
-                return None, None
+                return False
         except (ConnectionError, TimeoutError) as ex:
             self.disconnect("BNCS receive failed: %s" % ex)
-            return None, None
+            return False
+
+        return self.process_packets()
+
+    def feed(self, data):
+        # Handles data that was received by something other than this object.
+        self._decoder.feed(data)
+        return self.process_packets()
+
+    def process_packets(self):
+        self.last_talk = time.monotonic()
+
+        for pid, pak in self._decoder.packets():
+            if pid not in IGNORE_PACKETS:
+                self.parent.debug("Received BNCS packet 0x%02x (len: %i)", pid, len(pak))
+
+            self.packets_received += 1
+            self.bytes_received += len(pak)
+
+            started = time.perf_counter()
+            self.handle_packet(pid, pak)
+            self.handler_time += time.perf_counter() - started
+            if not self.connected:
+                return False
+
+        if self._decoder.error:
+            self.disconnect(self._decoder.error)
+            return False
+
+        return True
 
     def run(self):
         # First byte from the client determines the protocol
-        p = self.socket.recv(1)
-        if p[0] in protocols:
-            self.protocol = p[0]
-        else:
-            self.disconnect("Unsupported protocol selection (0x%02x)" % p[0])
+        if not self.select_protocol(self.socket.recv(1)):
             return
 
+        if self.writer is None:
+            self.start_writer()
+
         # Receive packets
         while self.connected:
-            pid, pak = self.receive()
-            if pid is None:
+            if not self.receive():
                 break
 
-            if pid in self._handlers.keys():
-                try:
-                    self._handlers.get(pid)(pid, pak)
-                except Exception as ex:
-                    self.parent.print("ERROR! Something happened while processing BNCS packet 0x%02x." % pid)
-                    self.parent.print("ERROR! Packet data dump:\n%s" % buffer.format_buffer(pak))
-                    self.parent.print("ERROR! Exception: %s" % ex)
+        self.disconnect("BNCS thread exited")
 
-                    if self.parent.server.debug:
-                        raise
+    def select_protocol(self, data):
+        if len(data) == 0:
+            self.disconnect("Client closed the connection")
+            return False
 
-        self.disconnect("BNCS thread exited")
+        if data[0] in protocols:
+            self.protocol = data[0]
+            return True
+        else:
+            self.disconnect("Unsupported protocol selection (0x%02x)" % data[0])
+            return False
+
+    def handle_packet(self, pid, pak):
+        if pid in self._handlers.keys():
+            try:
+                self._handlers.get(pid)(pid, pak)
+            except Exception as ex:
+                self.parent.print("ERROR! Something happened while processing BNCS packet 0x%02x." % pid)
+                self.parent.print("ERROR! Packet data dump:\n%s" % buffer.format_buffer(pak))
+                self.parent.print("ERROR! Exception: %s" % ex)
+
+                if self.parent.server.debug:
+                    raise
 
     def send_chat(self, eid, username, text, flags=0, ping=0, encoding='utf-8', errors=None):
-        pak = buffer.DataBuffer()
-        pak.insert_dword(eid)
-        pak.insert_dword(flags)
-        pak.insert_dword(ping)
-        pak.insert_dword(0)             # IP Address
-        pak.insert_dword(0xbaadf00d)    # Account number
-        pak.insert_dword(0xbaadf00d)    # Registration authority
-        pak.insert_string(username)
-        pak.insert_string(text, encoding, errors)
-        self.send(SID_CHATEVENT, pak)
+        self.send_chat_event(eid, username, chat_event(eid, username, text, flags, ping, encoding, errors))
+
+    def send_chat_event(self, eid, username, data):
+        # Sends a packet made by chat_event(), which can be shared by several clients.
+        #   Lets a slow client skip chat lines and stale flag updates if it falls behind.
+        key = (EID_USERFLAGS, username) if eid == EID_USERFLAGS else None
+        self._write(SID_CHATEVENT, data, key, eid == EID_TALK or eid == EID_EMOTE)
 
     def send_error(self, message):
         self.send_chat(EID_ERROR, GATEWAY_USER, message)
@@ -220,7 +619,7 @@ class ThinBncsClient(Thread):
             self.parent.print("BNCS login complete - authenticated to chat API")
             self.logged_on = True
 
-        pak = buffer.DataBuffer()
+        pak = PacketBuffer()
         if self.logon_type == -1:
             # Legacy login
             pak.insert_dword(0x01 if success else 0x00)
@@ -249,14 +648,14 @@ class ThinBncsClient(Thread):
             if username.startswith("[B]"):
                 account = username[3:]
 
-        pak = buffer.DataBuffer()
+        pak = PacketBuffer()
         pak.insert_string(username)
         pak.insert_string(stats)
         pak.insert_string(account)
         self.send(SID_ENTERCHAT, pak)
 
     def send_ping(self):
-        pak = buffer.DataBuffer()
+        pak = PacketBuffer()
         pak.insert_dword(random.getrandbits(32))
         self.send(SID_PING, pak)
 
@@ -265,20 +664,20 @@ class ThinBncsClient(Thread):
             self.disconnect("Sent repeat client auth.")
             return
 
-        pak.get_raw(8)      # First 8 bytes not needed
+        pak.skip(8)         # First 8 bytes not needed
         self.product = pak.get_dword(True)
         if self.product not in products:
             self.disconnect("Unsupported product (%s)" % self.product)
             return
 
         # Send ping packet
-        pak = buffer.DataBuffer()
+        pak = PacketBuffer()
         pak.insert_dword(random.getrandbits(32))
         self.send(SID_PING, pak)
 
-        pak = buffer.DataBuffer()
         if self.parent.server.do_version_check:
             # Send version check request
+            pak = PacketBuffer()
             pi = check_revision_data
             pak.insert_dword(self.logon_type)       # Logon type
             pak.insert_dword(self._server_token)    # Server token
@@ -293,43 +692,42 @@ class ThinBncsClient(Thread):
             self.send(SID_AUTH_INFO, pak)
         else:
             # Skip sending the request and immediately send the result.
-            pak.insert_dword(0x00)      # Success
-            pak.insert_string('')
-            self.send(SID_AUTH_CHECK, pak)
+            self.send_static(SID_AUTH_CHECK)
 
     def _handle_auth_check(self, pid, pak):
         self._client_token = pak.get_dword()
 
         # Send auth check response
-        pak = buffer.DataBuffer()
-        pak.insert_dword(0x00)      # Success
-        pak.insert_string('')
-        self.send(SID_AUTH_CHECK, pak)
+        self.send_static(SID_AUTH_CHECK)
 
     def _handle_auth_accountlogon(self, pid, pak):
         if self.logged_on:
             self.disconnect("Attempt to login again")
             return
 
-        pak.get_raw(32)     # Client key
+        pak.skip(32)        # Client key
         self.logon_type = 2
 
-        # Start the CAPI login process
-        self.parent.capi.authenticate(pak.get_string())
+        api_key = pak.get_string()
 
         # Send login response
-        pak = buffer.DataBuffer()
+        pak = PacketBuffer()
         pak.insert_dword(0)             # Logon accepted
         pak.insert_raw(b'\0' * 32)      # Account salt
         pak.insert_raw(b'\0' * 32)      # Server key
         self.send(SID_AUTH_ACCOUNTLOGON, pak)
 
+        # Start the CAPI login process. This comes after the response above because a shared chat API session can
+        #   send the logon proof right away.
+        self.parent.capi.authenticate(api_key)
+
     def _handle_enterchat(self, pid, pak):
-        if not (self.logged_on and self.parent.capi.connected()):
+        capi = self.parent.capi
+        if not (self.logged_on and (capi.connected() or capi.reconnecting)):
             self.disconnect("Attempt to enter chat before login")
             return
 
-        self.parent.capi.send_command("Botapichat.ConnectRequest")
+        self.parent.capi.enter_chat(self.parent)
 
     def _handle_chatcommand(self, pid, pak):
         text = pak.get_string(errors='ignore')
@@ -348,9 +746,9 @@ class ThinBncsClient(Thread):
                     if len(arg) == 1:
                         self.send_error("What do you want to say?")
                     else:
-                        self.parent.capi.send_chat(arg[1], "whisper", arg[0].replace('?', ' '))
+                        self.parent.capi.send_chat(arg[1], "whisper", arg[0].replace('?', ' '), self.parent)
             elif cmd in ["me", "emote"]:
-                self.parent.capi.send_chat(parts[1] if len(parts) > 1 else '', "emote")
+                self.parent.capi.send_chat(parts[1] if len(parts) > 1 else '', "emote", client=self.parent)
             elif cmd in ["ban", "kick", "unban", "designate"]:
                 if len(parts) == 1:
                     self.send_error(ERROR_NOTLOGGEDON)
@@ -361,28 +759,61 @@ class ThinBncsClient(Thread):
                         cmd = "op"
 
                     # The chat API does not support messages in ban/kick messages.
-                    self.parent.capi.bankickunban(arg[0], cmd)
+                    self.parent.capi.bankickunban(arg[0], cmd, self.parent)
             elif cmd == "capi":
                 if len(parts) > 1:
                     sub = parts[1].split(' ', maxsplit=1)
-                    if sub[0].lower() == "debug":
+                    if sub[0].lower() == "debug" and len(sub) > 1:
+                        # Debug output can be turned on for just this client
+                        setting = sub[1].strip().lower()
+                        if setting in ["on", "off"]:
+                            self.parent.debugging = (setting == "on")
+                            self.send_chat(EID_INFO, GATEWAY_USER, "Debug messages %s." %
+                                           ("enabled" if self.parent.debugging else "disabled"))
+                        else:
+                            self.send_error("Usage: /capi debug [on|off]")
+                    elif sub[0].lower() == "debug":
                         last_message = self.parent.capi.last_talk
-                        self.send_chat(EID_INFO, GATEWAY_USER, "Last CAPI message received: %s (%s seconds ago)" %
-                                       (last_message, int((datetime.now() - last_message).total_seconds())))
-                        self.send_chat(EID_INFO, GATEWAY_USER, "CAPI connected: %s" % self.parent.capi.connected())
+                        self.send_chat(EID_INFO, GATEWAY_USER, "Last CAPI message received: %s seconds ago" %
+                                       int(time.monotonic() - last_message))
+                        self.send_chat(EID_INFO, GATEWAY_USER, "CAPI connected: %s (requests waiting: %i)" %
+                                       (self.parent.capi.connected(), self.parent.capi.pending_requests()))
+                        o = self.parent.capi.outbox
+                        self.send_chat(EID_INFO, GATEWAY_USER, "CAPI send queue: %i moderation, %i chat (rate: %.2f/s, "
+                                       "wait p90: %ims, rate limited: %i, rejected: %i)" %
+                                       (len(o.lanes[0]), len(o.lanes[1]), o.rate, o.wait_times.percentile(90) * 1000,
+                                        o.limited, o.rejected))
+                        q = self.outbound
+                        self.send_chat(EID_INFO, GATEWAY_USER, "BNCS queue: %i packets, %i bytes (peak: %i bytes, "
+                                       "dropped: %i, coalesced: %i)" %
+                                       (len(q), q.size, q.peak_bytes, q.dropped, q.coalesced))
                         self.send_chat(EID_INFO, GATEWAY_USER, "Connection monitor active: %s" %
-                                       self.parent.server.monitor.is_alive())
+                                       self.parent.server.monitor_active())
+                    elif sub[0].lower() == "latency":
+                        # Chat API response times for every client on this server
+                        latency, timeouts = self.parent.server.request_stats.snapshot()
+                        for command in sorted(set(latency) | set(timeouts)):
+                            h = latency.get(command)
+                            if h is None:
+                                text = "no responses"
+                            else:
+                                text = "%i responses, p50 %ims, p90 %ims, p99 %ims, max %ims" % \
+                                       (h.count, h.percentile(50) * 1000, h.percentile(90) * 1000,
+                                        h.percentile(99) * 1000, h.max * 1000)
+                            self.send_chat(EID_INFO, GATEWAY_USER, "%s: %s, %i timed out" %
+                                           (command.split('.')[-1], text, timeouts.get(command, 0)))
                     elif sub[0].lower() == "send":
                         if len(sub) == 1:
                             self.send_error("You must specify a message to send.")
                         else:
                             arg = sub[1].split(' ', maxsplit=1)
                             try:
-                                self.parent.capi.send_command(arg[0], json.loads(arg[1]) if len(arg) > 1 else None)
+                                self.parent.capi.send_command(arg[0], json.loads(arg[1]) if len(arg) > 1 else None,
+                                                              self.parent)
                             except json.JSONDecodeError as ex:
                                 self.send_error("Invalid JSON payload: %s" % ex)
                 else:
-                    self.send_chat(EID_INFO, GATEWAY_USER, "Available sub-commands: debug, send")
+                    self.send_chat(EID_INFO, GATEWAY_USER, "Available sub-commands: debug, latency, send")
             else:
                 if cmd in unsupported_commands:
                     if not self.parent.server.ignore_unsupported_commands:
@@ -391,17 +822,17 @@ class ThinBncsClient(Thread):
                             if name in [self.username.lower(), "*" + self.username.lower()]:
                                 # Send flag updates for every user in the channel
                                 for user in self.parent.capi.users.values():
-                                    self.send_chat(EID_USERFLAGS, user.name, user.get_statstring(), user.get_flags())
+                                    self.send_chat(EID_USERFLAGS, user.encoded_name, user.statstring, user.flag_int)
                                 return
 
                         self.send_error("That command is not supported by the chat API.")
 
-                    self.parent.debug("Unsupported command: %s" % repr(parts))
+                    self.parent.debug("Unsupported command: %r", parts)
                 else:
                     self.send_error("That is not a valid command.")
-                    self.parent.debug("Invalid command: %s" % repr(parts))
+                    self.parent.debug("Invalid command: %r", parts)
         else:
-            self.parent.capi.send_chat(text)
+            self.parent.capi.send_chat(text, client=self.parent)
 
     def _handle_logon_response(self, pid, pak):
         if self.logged_on:
@@ -409,17 +840,14 @@ class ThinBncsClient(Thread):
             return
 
         self._client_token = pak.get_dword()
-        pak.get_raw(24)     # Server token and password hash
+        pak.skip(24)        # Server token and password hash
         self.logon_type = (0 if pid == SID_LOGONRESPONSE2 else -1)
 
         # Start CAPI login process
         self.parent.capi.authenticate(pak.get_string())
 
     def _handle_query_realms2(self, pid, pak):
-        pak = buffer.DataBuffer()
-        pak.insert_dword(0)
-        pak.insert_dword(0)
-        self.send(SID_QUERYREALMS2, pak)
+        self.send_static(SID_QUERYREALMS2)
 
     def _handle_get_filetime(self, pid, pak):
         req_id = pak.get_dword()
@@ -427,7 +855,7 @@ class ThinBncsClient(Thread):
         filename = pak.get_string()
 
         # No files ever exist.
-        pak = buffer.DataBuffer()
+        pak = PacketBuffer()
         pak.insert_dword(req_id)
         pak.insert_dword(unknown)
         pak.insert_long(0)
@@ -436,10 +864,7 @@ class ThinBncsClient(Thread):
 
     def _handle_get_icon_data(self, pid, pak):
         # Packet has no contents
-        pak = buffer.DataBuffer()
-        pak.insert_long(0)
-        pak.insert_string('icons.bni')
-        self.send(SID_GETICONDATA, pak)
+        self.send_static(SID_GETICONDATA)
 
     def _handle_start_versioning(self, pid, pak):
         if self.product is not None:
@@ -453,22 +878,17 @@ class ThinBncsClient(Thread):
             return
 
         # Send SID_CLIENTID
-        pak = buffer.DataBuffer()
-        pak.insert_dword(0)
-        pak.insert_dword(0)
-        pak.insert_dword(0)
-        pak.insert_dword(0)
-        self.send(SID_CLIENTID, pak)
+        self.send_static(SID_CLIENTID)
 
         # Send SID_LOGONCHALLENGEEX2
-        pak = buffer.DataBuffer()
+        pak = PacketBuffer()
         pak.insert_dword(0)                     # UDP Value
         pak.insert_dword(self._server_token)    # Server token
         self.send(SID_LOGONCHALLENGEEX, pak)
 
-        pak = buffer.DataBuffer()
         if self.parent.server.do_version_check:
             # Send SID_STARTVERSIONING
+            pak = PacketBuffer()
             pi = check_revision_data
             pak.insert_long(pi[0])                  # MPQ filetime
             pak.insert_string(pi[1])                # MPQ filename
@@ -476,9 +896,7 @@ class ThinBncsClient(Thread):
             self.send(SID_STARTVERSIONING, pak)
         else:
             # Skip the version check
-            pak.insert_dword(0x02)      # Result: success
-            pak.insert_string('')
-            self.send(SID_REPORTVERSION, pak)
+            self.send_static(SID_REPORTVERSION)
 
     def _handle_report_version(self, pid, pak):
         pak.get_dword()
@@ -488,16 +906,10 @@ class ThinBncsClient(Thread):
             return
 
         # Send version response
-        pak = buffer.DataBuffer()
-        pak.insert_dword(0x02)      # Result: success
-        pak.insert_string('')       # Patch path
-        self.send(SID_REPORTVERSION, pak)
+        self.send_static(SID_REPORTVERSION)
 
     def _handle_cd_key2(self, pid, pak):
-        pak.get_raw(20)     # Key properties and server token
+        pak.skip(20)        # Key properties and server token
         self._client_token = pak.get_dword()
 
-        pak = buffer.DataBuffer()
-        pak.insert_dword(0x01)      # Result: OK
-        pak.insert_string('')
-        self.send(SID_CDKEY2, pak)
+        self.send_static(SID_CDKEY2)
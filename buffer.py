@@ -1,5 +1,15 @@
 
-from struct import pack, unpack
+from struct import Struct
+
+
+BYTE = Struct('<B')
+WORD = Struct('<H')
+DWORD = Struct('<L')
+LONG = Struct('<Q')
+
+
+# Byte values shown as themselves in the character column of a dump; everything else is shown as '.'
+_printable = bytes((b if 0x20 <= b <= 0x7F else 0x2E) for b in range(256))
 
 
 def format_buffer(buff):
@@ -9,100 +19,131 @@ def format_buffer(buff):
 
     if isinstance(buff, (DataBuffer, DataReader)):
         data = buff.data
-    elif not isinstance(buff, (bytes, bytearray)):
+    elif not isinstance(buff, (bytes, bytearray, memoryview)):
         raise TypeError("Buffer must be a bytes-based object.")
     else:
         data = buff
 
-    data_length = len(data)
-    mod = data_length % 16
-
-    ret = ''
-    # Format _most_ of the buffer.
-    for i in range(0, len(data)):
-        if i != 0 and i % 16 == 0:
-            ret += '\t'
-            # 16 bytes at a time
-            for j in range(i - 16, i):
-                ret += ('.' if data[j] < 0x20 or data[j] > 0x7F else chr(data[j]))
-            ret += '\n'
-
-        ret += ('00' + hex(data[i])[2:])[-2:] + ' '
-
-    # If the buffer length isn't a multiple of 16, add padding.
-    if mod != 0:
-        ret = ret.ljust(len(ret) + ((16 - mod) * 3))
-        j = (data_length - mod)
-    else:
-        j = data_length - 16
-
-    ret += '\t'
-
-    # Finish the line
-    for j in range(j, data_length):
-        ret += ('.' if data[j] < 0x20 or data[j] > 0x7F else chr(data[j]))
-    return ret + '\n'
+    data = bytes(data)
+    lines = []
+    # 16 bytes per line, with the last line padded to line up the characters.
+    for i in range(0, len(data), 16):
+        row = data[i:(i + 16)]
+        lines.append('%-48s\t%s\n' % (row.hex(' ') + ' ', row.translate(_printable).decode('ascii')))
+    return ''.join(lines)
 
 
 class DataBuffer:
-    def __init__(self):
-        self.data = b''
+    """Writes values into a preallocated bytearray that grows as needed.
+
+    'reserve' bytes at the start of the buffer are left empty so that a header can be filled in later with patch().
+    """
+    def __init__(self, size=64, reserve=0):
+        self.buffer = bytearray(max(size, reserve))
+        self.length = reserve
 
     def __len__(self):
-        return len(self.data)
+        return self.length
+
+    @property
+    def data(self):
+        return memoryview(self.buffer)[:self.length]
+
+    def _reserve(self, count):
+        # Make sure there is room for 'count' more bytes
+        needed = self.length + count
+        if needed > len(self.buffer):
+            buff = bytearray(max(needed, len(self.buffer) * 2))
+            buff[:self.length] = memoryview(self.buffer)[:self.length]
+            self.buffer = buff
+
+    def insert_struct(self, fmt, *values):
+        # Packs several values at once with a precompiled Struct
+        self._reserve(fmt.size)
+        fmt.pack_into(self.buffer, self.length, *values)
+        self.length += fmt.size
+
+    def patch(self, fmt, offset, *values):
+        # Overwrites previously written or reserved data in place.
+        fmt.pack_into(self.buffer, offset, *values)
 
     def insert_raw(self, data):
-        self.data = self.data + data
+        count = len(data)
+        self._reserve(count)
+        self.buffer[self.length:(self.length + count)] = data
+        self.length += count
 
     def insert_byte(self, byte):
-        self.insert_raw(pack('<B', byte))
+        self.insert_struct(BYTE, byte)
 
     def insert_word(self, word):
-        self.insert_raw(pack('<H', word))
+        self.insert_struct(WORD, word)
 
     def insert_dword(self, dword):
         if type(dword) == str:
             self.insert_raw(dword[::-1].encode('ascii'))
         else:
-            self.insert_raw(pack('<L', dword))
+            self.insert_struct(DWORD, dword)
 
     def insert_long(self, long):
-        self.insert_raw(pack('<Q', long))
+        self.insert_struct(LONG, long)
 
     def insert_string(self, s, encoding='utf-8', errors=None):
-        self.insert_raw((s + chr(0)).encode(encoding, errors or 'strict'))
+        # Bytes are taken as already encoded
+        self.insert_raw(s if isinstance(s, bytes) else s.encode(encoding, errors or 'strict'))
+        self.insert_struct(BYTE, 0)
 
 
 class DataReader:
-    def __init__(self, data):
-        self.data = data
+    """Reads values from a bytes or bytearray object without copying it.
+
+    Only the 'length' bytes starting at 'offset' are visible to the reader, so a single receive buffer can be shared by
+    the readers for every packet in it.
+    """
+    def __init__(self, data, offset=0, length=None):
+        self.source = data
+        self.offset = offset
+        self.length = (len(data) - offset) if length is None else length
+        self.data = memoryview(data)[offset:(offset + self.length)]
         self.position = 0
 
     def __len__(self):
-        return len(self.data)
+        return self.length
+
+    def skip(self, length):
+        self.position = self.position + length
 
     def get_raw(self, length=-1):
         if length == -1:
-            length = (len(self.data) - self.position)
+            length = (self.length - self.position)
 
-        r = self.data[self.position:(self.position + length)]
+        r = bytes(self.data[self.position:(self.position + length)])
         self.position = self.position + length
         return r
 
+    def _get_struct(self, fmt):
+        r = fmt.unpack_from(self.data, self.position)[0]
+        self.position += fmt.size
+        return r
+
     def get_byte(self):
-        return unpack('<B', self.get_raw(1))[0]
+        return self._get_struct(BYTE)
 
     def get_word(self):
-        return unpack('<H', self.get_raw(2))[0]
+        return self._get_struct(WORD)
 
     def get_dword(self, as_str=False):
-        val = self.get_raw(4)
-        return val.decode('ascii')[::-1] if as_str else unpack('<L', val)[0]
+        if as_str:
+            r = str(self.data[self.position:(self.position + 4)], 'ascii')[::-1]
+            self.position += 4
+            return r
+        return self._get_struct(DWORD)
 
     def get_long(self):
-        return unpack('<Q', self.get_raw(8))[0]
+        return self._get_struct(LONG)
 
     def get_string(self, encoding='utf-8', errors=None):
-        r = self.get_raw(self.data.index(b'\00', self.position) - self.position).decode(encoding, errors or 'strict')
-        self.position += 1
+        end = self.source.index(b'\00', self.offset + self.position, self.offset + self.length) - self.offset
+        r = str(self.data[self.position:end], encoding, errors or 'strict')
+        self.position = end + 1
         return r
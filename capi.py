@@ -1,14 +1,30 @@
 
 import bncs
+import codec
+from stats import Histogram
 
+import random
+import socket
 import ssl
-import json
-from threading import Thread
+import sys
+from threading import Thread, Lock, RLock
+from collections import namedtuple, deque
 from datetime import datetime
+from urllib.parse import urlparse
+import time
 
 import websocket
 
 
+DEFAULT_ENDPOINT = "wss://connect-bot.classic.blizzard.com/v1/rpc/chat"
+CONNECT_TIMEOUT = 10        # Seconds allowed for the TCP, TLS and websocket handshakes together
+
+# Reconnecting after a session loses its connection, if the server allows it
+RECONNECT_DELAY = 1         # Seconds before the first attempt, doubled after each one
+RECONNECT_DELAY_MAX = 60
+RECONNECT_ATTEMPTS = 10     # Attempts before the session's clients are disconnected
+RECONNECT_STABLE_AFTER = 60 # Seconds a connection must last for the attempts to be counted from the start again
+
 status_codes = {
     0: {
         0: None     # Success
@@ -37,6 +53,20 @@ send_message_types = {
 }
 
 
+# Requests that are rate limited, by priority. Moderation actions are sent ahead of waiting chat messages.
+PRIORITY_MODERATION = 0
+PRIORITY_CHAT = 1
+
+request_priorities = {command: PRIORITY_MODERATION for command in bku_actions.values()}
+request_priorities.update({command: PRIORITY_CHAT for command in send_message_types.values()})
+
+# Requests that are remembered with their payload, because it's needed again to handle the response
+keep_request_payload = {"Botapichat.SendWhisperRequest"}
+
+# A request waiting for its response, and the client that sent it
+PendingRequest = namedtuple("PendingRequest", ["command", "sent", "context", "origin"])
+
+
 # BNCS translation
 message_eids = {
     "channel": bncs.EID_TALK,
@@ -55,6 +85,48 @@ user_flags = {
 }
 
 
+_ssl_context = None
+_tls_sessions = {}      # (host, port) -> TLS session from the last connection, which the next one tries to resume
+
+
+def ssl_context():
+    # Every connection shares one context, so it's only set up once. The server's certificate isn't checked.
+    global _ssl_context
+    if _ssl_context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        _ssl_context = context
+    return _ssl_context
+
+
+def open_websocket(endpoint, timeout=CONNECT_TIMEOUT):
+    """Returns a websocket connected to the chat API. Raises OSError or WebSocketException if it fails."""
+    ws = websocket.WebSocket()
+    url = urlparse(endpoint)
+    if url.scheme != "wss":
+        ws.connect(endpoint, timeout=timeout)
+        ws.settimeout(None)
+        return ws
+
+    # The TLS connection is made here instead of by the websocket library, so the last session can be resumed.
+    address = (url.hostname, url.port or 443)
+    sock = socket.create_connection(address, timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock = ssl_context().wrap_socket(sock, server_hostname=url.hostname, session=_tls_sessions.get(address))
+        ws.connect(endpoint, socket=sock)
+    except (OSError, websocket.WebSocketException):
+        sock.close()
+        raise
+
+    # TLS 1.3 tickets arrive after the handshake, so the session is saved once the upgrade response has been read.
+    if sock.session is not None:
+        _tls_sessions[address] = sock.session
+    ws.settimeout(None)
+    return ws
+
+
 def get_flag_int(flags):
     value = 0
     for f in flags:
@@ -62,66 +134,277 @@ def get_flag_int(flags):
     return value
 
 
+# Users' flags are kept as a bitmask of the flag names the API has used, each of which is given a bit when first seen.
+#   Masks are remembered for each list of flags received, so a list only has to be looked at once.
+capi_flag_bits = {}         # Lowercase flag name -> bit
+_flag_masks = {}            # Tuple of flag names -> (bitmask, BNCS flags)
+_flag_lock = Lock()
+
+# Users with the same attributes share one dictionary, which must not be changed, and its statstring.
+_attribute_sets = {}        # Tuple of (key, value) pairs -> (dictionary, statstring)
+MAX_ATTRIBUTE_SETS = 1024
+
+
+def get_flag_mask(flags):
+    """Returns the bitmask for a list of flag names, along with the BNCS flags for them."""
+    key = tuple(flags)
+    found = _flag_masks.get(key)
+    if found is None:
+        with _flag_lock:
+            mask = 0
+            for f in flags:
+                mask |= capi_flag_bits.setdefault(f.lower(), 1 << len(capi_flag_bits))
+            found = (mask, get_flag_int(flags))
+            if len(_flag_masks) < MAX_ATTRIBUTE_SETS:
+                _flag_masks[key] = found
+    return found
+
+
+def get_attributes(attributes):
+    """Returns a shared dictionary of the attributes given by the API, along with the statstring for them.
+
+    The API gives attributes as a list of {"key": k, "value": v} objects, but a dictionary is also accepted.
+    """
+    pairs = []
+    if isinstance(attributes, list):
+        for item in attributes:
+            if isinstance(item, dict):
+                pairs.append((item.get("key"), item.get("value")))
+            else:
+                print("Unexpected attribute format (%s): %s" % (type(attributes).__name__, attributes))
+                break
+    elif isinstance(attributes, dict):
+        pairs = attributes.items()
+    elif attributes is not None:
+        print("Unexpected attribute format (%s): %s" % (type(attributes).__name__, attributes))
+
+    key = tuple(pairs)
+    try:
+        found = _attribute_sets.get(key)
+    except TypeError:
+        # A value that can't be hashed, so this set can't be shared
+        key, found = None, None
+
+    if found is None:
+        shared = {(sys.intern(k) if isinstance(k, str) else k): (sys.intern(v) if isinstance(v, str) else v)
+                  for k, v in pairs}
+        found = (shared, get_statstring(shared).encode('utf-8'))
+        if key is not None and len(_attribute_sets) < MAX_ATTRIBUTE_SETS:
+            _attribute_sets[key] = found
+    return found
+
+
+def normalize_name(name):
+    # Toon names are not case-sensitive and may be given with a '*' prefix
+    if name.startswith("*"):
+        name = name[1:]
+    return name.lower()
+
+
 def get_statstring(attributes):
     # If these attributes haven't been simplified, do it.
     if isinstance(attributes, list):
-        user = CapiUser(None, None, attributes=attributes)
-        attributes = user.attributes
+        attributes = get_attributes(attributes)[0]
 
     string = attributes.get("ProgramId", "CHAT")[::-1]
     return string
 
 
 class CapiUser(object):
+    # A user is kept for everyone in the channel of every bot, so users only have slots and share what they can: names
+    #   are interned and the attributes dictionary comes from get_attributes(). What's sent to BNCS clients for a user
+    #   (flags, statstring and encoded name) is kept ready to relay, and only worked out again when it changes.
+    __slots__ = ("id", "name", "encoded_name", "flags", "flag_int", "attributes", "statstring")
+
     def __init__(self, user_id, name, flags=None, attributes=None):
         self.id = user_id
-        self.name = name
-        self.flags = flags or []
+        self.name = sys.intern(name) if name else name
+        self.encoded_name = name.encode('utf-8') if name else b''
+        self.flags, self.flag_int = get_flag_mask(flags or ())
+        self.attributes, self.statstring = get_attributes(attributes)
+
+    def set_flags(self, flags):
+        # Returns True if the flags changed.
+        mask, flag_int = get_flag_mask(flags)
+        if mask == self.flags:
+            return False
 
-        self.attributes = {}
-        self.set_attributes(attributes)
+        self.flags = mask
+        self.flag_int = flag_int
+        return True
 
     def set_attributes(self, attributes):
-        # Normalize attributes into a simple dictionary.
-        self.attributes = {}
-        if isinstance(attributes, list):
-            for item in attributes:
-                if isinstance(item, dict):
-                    key, value = item.get("key"), item.get("value")
-                    self.attributes[key] = value
-                else:
-                    print("Unexpected attribute format (%s): %s" % (type(attributes).__name__, attributes))
-                    break
-        elif isinstance(attributes, dict):
-            self.attributes = attributes
-        elif attributes is not None:
-            print("Unexpected attribute format (%s): %s" % (type(attributes).__name__, attributes))
+        # Returns True if the attributes changed.
+        shared, statstring = get_attributes(attributes)
+        if shared is self.attributes or shared == self.attributes:
+            return False
+
+        self.attributes = shared
+        self.statstring = statstring
+        return True
 
-    def get_flags(self):
-        return get_flag_int(self.flags)
 
-    def get_statstring(self):
-        return get_statstring(self.attributes)
+class RequestScheduler(object):
+    """Limits how fast requests are sent to the chat API, using a token bucket.
+
+    Tokens are added at 'rate' per second, up to 'burst'. A request can be sent right away if a token is available and
+    nothing is waiting, otherwise it's queued by priority. Each time the API reports a rate limit, the rate is halved
+    and the bucket is emptied. Successful requests bring it back up to the configured rate a little at a time.
+    A rate of 0 turns the limit off, and nothing is queued.
+    """
+    def __init__(self, rate=2.0, burst=5, max_waiting=100):
+        self.max_rate = rate
+        self.min_rate = rate / 8
+        self.rate = rate
+        self.burst = burst
+        self.max_waiting = max_waiting      # Per priority
+
+        self.lock = Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lanes = (deque(), deque())
+        self.draining = False               # Whether something is waiting to send queued requests
+
+        self.wait_times = Histogram()
+        self.limited = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    @property
+    def enabled(self):
+        return self.max_rate > 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def submit(self, priority, request, start_draining):
+        """Returns True if the request should be sent now, or False if it can't be sent because too many are waiting.
+
+        Otherwise the request is queued and None is returned. start_draining() is called with the time the next one
+        can be sent if nothing is sending queued requests yet.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if self.tokens >= 1 and len(self) == 0:
+                self.tokens -= 1
+                self.wait_times.observe(0)
+                return True
+            elif len(self.lanes[priority]) >= self.max_waiting:
+                self.rejected += 1
+                return False
+
+            self.lanes[priority].append((now, request))
+            if not self.draining:
+                self.draining = True
+                start_draining(self._next_token(now))
+            return None
+
+    def _next_token(self, now):
+        return now + max(1 - self.tokens, 0) / self.rate
+
+    def take(self):
+        """Returns the next queued request if it can be sent now, otherwise None."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens < 1:
+                return None
+
+            for lane in self.lanes:
+                if len(lane) > 0:
+                    queued, request = lane.popleft()
+                    self.tokens -= 1
+                    self.wait_times.observe(now - queued)
+                    return request
+            return None
+
+    def next_deadline(self):
+        """Returns when the next queued request can be sent, or None (and stops draining) if nothing is waiting."""
+        with self.lock:
+            if len(self) == 0:
+                self.draining = False
+                return None
+            return self._next_token(time.monotonic())
+
+    def rate_limited(self):
+        with self.lock:
+            self.limited += 1
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.tokens = 0
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.rate + (self.max_rate / 20), self.max_rate)
+
+    def clear(self):
+        """Removes every queued request, and returns them."""
+        with self.lock:
+            removed = []
+            for lane in self.lanes:
+                removed.extend(request for queued, request in lane)
+                lane.clear()
+            return removed
 
 
 class CapiClient(Thread):
+    """A chat API session for one or more BNCS clients.
+
+    Normally each client has its own session. If the server shares sessions, clients that log on with the same API key
+    are attached to the first one's session: events are relayed to all of them and their requests are sent through the
+    one connection, with responses going back to the client that sent the request. 'parent' is the client that looks
+    after the session, and it's handed on to another client if it leaves.
+    """
     def __init__(self, parent, endpoint=None):
         self.parent = parent
-        self.endpoint = endpoint or "wss://connect-bot.classic.blizzard.com/v1/rpc/chat"
+        self.endpoint = endpoint or DEFAULT_ENDPOINT
         self.api_key = None
 
+        # Lists are replaced instead of changed, so they can be looped over without a lock
+        self.clients = [parent]     # Clients attached to this session
+        self.listeners = []         # Clients that have entered chat, which events are relayed to
+        self._clients_lock = Lock()
+        self._relay_lock = RLock()  # Held while relaying events, so a client entering chat doesn't miss any
+
         self.users = {}
+        self.user_names = {}        # Normalized toon name -> CapiUser
         self.channel = None
         self.username = None
+        self.statstring = None
         self.last_talk = None
 
         self._connected = False
+        self._connected_since = None
         self._disconnecting = False
         self._authenticating = False
+        self._authenticated = False
+        self._connect_sent = False
+        self.reconnecting = False
+        self._reconnect_attempts = 0
+        self._resync = None         # Normalized name -> CapiUser from before reconnecting, until the channel is listed
+        self._resync_channel = None
+        self._resync_waiting = []   # Clients that entered chat during a resync, which are sent the channel after it
+        self._released = False      # Set if the client moved to a shared session and this connection was closed
+        self._closed = False        # Set once every client has left, so no more can join
         self._last_request_id = 0
-        self._requests = {}
+        self._requests = {}         # Request ID -> PendingRequest, oldest first
+        self._requests_lock = Lock()
+        self.outbox = RequestScheduler(parent.server.capi_rate, parent.server.capi_burst)
         self._received_users = False
 
+        # Running totals, for metrics
+        self.connects = 0
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.handler_time = 0.0
+
         self._handlers = {
             "Botapiauth.AuthenticateResponse": self._handle_auth_response,
             "Botapichat.ConnectResponse": self._handle_connect_response,
@@ -145,60 +428,253 @@ class CapiClient(Thread):
         if isinstance(identifier, int):
             return self.users.get(identifier)
         elif isinstance(identifier, str):
-            if identifier.startswith("*"):
-                identifier = identifier[1:]
-
-            for user in self.users.values():
-                if user.name.lower() == identifier.lower():
-                    return user
+            return self.user_names.get(normalize_name(identifier))
         return None
 
-    def connect(self):
-        self.socket = websocket.WebSocket(sslopt={"cert_reqs": ssl.CERT_NONE})
-        try:
-            self.socket.connect(self.endpoint)
-        except (websocket.WebSocketException, TimeoutError, ConnectionError):
-            return False
+    def add_user(self, user):
+        self.users[user.id] = user
+        if user.name:
+            self.user_names[sys.intern(normalize_name(user.name))] = user
+
+    def remove_user(self, user):
+        del self.users[user.id]
+        if user.name:
+            self.user_names.pop(normalize_name(user.name), None)
+
+    def connect(self, pool=None):
+        # A connection waiting in the pool is used if there is one
+        sock = pool.take() if pool is not None else None
+        if sock is None:
+            try:
+                sock = open_websocket(self.endpoint)
+            except (websocket.WebSocketException, OSError):
+                return False
 
+        self.attach(sock)
+        return True
+
+    def attach(self, sock):
+        # Takes ownership of an already connected websocket
+        self.socket = sock
+        self.connects += 1
         self._connected = True
         self._disconnecting = False
-        self.last_talk = datetime.now()
-        return True
+        self.last_talk = self._connected_since = time.monotonic()
 
     def disconnect(self, reason=None):
-        if self._disconnecting:
+        # Every client attached to the session is disconnected with it
+        if self._disconnecting or self._released:
             return
 
         self._disconnecting = True
+        self.reconnecting = False
         self.send_command("Botapichat.DisconnectRequest")
-        self.parent.close(reason)
+        self._unregister()
+        for client in self.clients:
+            client.close(reason)
+
+    def join(self, client):
+        """Attaches another client to this session. Returns False if the session has closed."""
+        with self._clients_lock:
+            if self._closed or not (self.connected() or self.reconnecting):
+                return False
+            self.clients = self.clients + [client]
+            waiting = self._authenticating
+
+        # If the session is still authenticating, the response is sent to every client when it arrives.
+        if not waiting:
+            client.bncs.send_logon_response(True)
+        return True
+
+    def detach(self, client):
+        # Called when a client closes. The session is closed once no clients are left.
+        with self._clients_lock:
+            if client not in self.clients:
+                return
+            self.clients = [c for c in self.clients if c is not client]
+            self.listeners = [c for c in self.listeners if c is not client]
+            self._resync_waiting = [c for c in self._resync_waiting if c is not client]
+
+            if len(self.clients) > 0:
+                if self.parent is client:
+                    self.parent = self.clients[0]
+                return
+            self._closed = True
+            self.reconnecting = False
+
+        self._unregister()
+        if self.connected():
+            self.socket.close()
+            self._connected = False
+
+    def lost(self, reason):
+        """Handles the connection failing. Returns True if the session will reconnect.
+
+        Otherwise its clients are disconnected, which is all that happens unless the server allows reconnecting and the
+        session had logged on.
+        """
+        if not self.reconnecting:
+            if self._released or self._disconnecting or self._closed:
+                return False
+            elif not (self._authenticated and self.parent.server.capi_reconnect):
+                self.disconnect(reason)
+                return False
+
+            # A connection that lasted a while starts over with short delays
+            if time.monotonic() - self._connected_since >= RECONNECT_STABLE_AFTER:
+                self._reconnect_attempts = 0
+
+            self.reconnecting = True
+            self.parent.print("Lost connection to the chat API (%s) - reconnecting" % reason)
+            self.relay(bncs.EID_INFO, bncs.GATEWAY_USER, "Lost connection to the chat API. Reconnecting...")
+
+        if self._connected:
+            self._connected = False
+            try:
+                self.socket.close()
+            except (OSError, websocket.WebSocketException):
+                pass
+
+        # Requests sent on the lost connection will never be answered, so they're given up on now instead of timing out
+        #   later, when their handlers would act on the new connection.
+        with self._requests_lock:
+            abandoned = list(self._requests.values())
+            self._requests.clear()
+        for pending in abandoned:
+            if pending.origin is not None:
+                pending.origin.error("The connection to the chat API was lost before %s was answered." %
+                                     pending.command)
+        return True
+
+    def reconnect_delay(self):
+        """Returns the seconds to wait before trying to reconnect, or None if the session has stopped reconnecting."""
+        if not self.reconnecting:
+            return None
+        elif self._reconnect_attempts >= RECONNECT_ATTEMPTS:
+            self.disconnect("Unable to reconnect to the chat API")
+            return None
+
+        delay = min(RECONNECT_DELAY * (2 ** self._reconnect_attempts), RECONNECT_DELAY_MAX)
+        self._reconnect_attempts += 1
+
+        # Spread out, so bots that lost their connections together don't all come back at once
+        return random.uniform(delay / 2, delay)
+
+    def resume(self):
+        # Called once a new connection has been attached. Chat is entered again after logging on.
+        self.send_command("Botapiauth.AuthenticateRequest", {"api_key": self.api_key})
+
+    def _release(self):
+        # The client is using a shared session instead, so this connection isn't needed.
+        self._released = True
+        self._connected = False
+        self.socket.close()
+
+    def _unregister(self):
+        server = self.parent.server
+        with server.sessions_lock:
+            if server.sessions.get(self.api_key) is self:
+                del server.sessions[self.api_key]
 
     def send_ping(self):
         self.socket.ping(str(datetime.now()))
 
-    def send_command(self, command, payload=None):
+    def send_command(self, command, payload=None, client=None):
+        # 'client' is the client sending the request, which is told about any problems with it
         if not self.connected():
+            if self.reconnecting and client is not None:
+                client.error("Not connected to the chat API. Reconnecting...")
             return False
 
-        rid = self._last_request_id = (self._last_request_id + 1)
+        priority = request_priorities.get(command)
+        if priority is not None and self.outbox.enabled:
+            result = self.outbox.submit(priority, (command, payload, client), self._start_draining)
+            if result is None:
+                return True         # Queued
+            elif result is False:
+                (client or self.parent).error("Too many messages are waiting to be sent.")
+                return False
 
-        msg = {
-            "command": command,
-            "request_id": rid,
-            "payload": payload or {}
-        }
+        return self._send_now(command, payload, client)
+
+    def _start_draining(self, deadline):
+        # The timer stops by itself once nothing is waiting or the connection is closed.
+        self.parent.server.scheduler.call_at(deadline, self._send_queued)
+
+    def _send_queued(self):
+        # Timer callback that sends queued requests as the rate limit allows.
+        while self.connected():
+            request = self.outbox.take()
+            if request is None:
+                return self.outbox.next_deadline()
+            self._send_now(*request)
+
+        for command, payload, client in self.outbox.clear():
+            if client is not None:
+                client.error("The connection to the chat API was lost before %s was sent." % command)
+        return self.outbox.next_deadline()
+
+    def _send_now(self, command, payload, client=None):
+        payload = payload or {}
+
+        with self._requests_lock:
+            rid = self._last_request_id = (self._last_request_id + 1)
 
         try:
-            self.socket.send(json.dumps(msg), websocket.ABNF.OPCODE_TEXT)
-            self.parent.debug("Sent CAPI command: %s" % command)
+            data = codec.encode_request(command, rid, payload)
+        except (TypeError, ValueError, OverflowError) as ex:
+            # Payloads from '/capi send' can contain values the JSON library can't write, like very large numbers.
+            (client or self.parent).error("Could not encode %s: %s" % (command, ex))
+            return False
+
+        # The request is registered before it's sent, because the response can arrive on another thread first.
+        with self._requests_lock:
+            self._requests[rid] = PendingRequest(command, time.monotonic(),
+                                                 payload if command in keep_request_payload else None, client)
+
+        try:
+            self.socket.send(data, websocket.ABNF.OPCODE_TEXT)
+            self.parent.debug("Sent CAPI command: %s", command)
+            self.messages_sent += 1
+            self.bytes_sent += len(data)
         except (TimeoutError, websocket.WebSocketException, ConnectionError) as ex:
-            self.disconnect("CAPI send failed: %s" % ex)
+            with self._requests_lock:
+                self._requests.pop(rid, None)
+            self.lost("CAPI send failed: %s" % ex)
             return False
 
-        self._requests[rid] = msg
         return rid
 
-    def send_chat(self, message, mtype="channel", target=None):
+    def pending_requests(self):
+        return len(self._requests)
+
+    def expire_requests(self, timeout):
+        """Gives up on requests that have waited more than 'timeout' seconds for a response.
+
+        Each one is handled as if its response had arrived with a 'Request timed out' status, or reported to the BNCS
+        client as an error if there is no handler for the response.
+        """
+        expired = []
+        cutoff = time.monotonic() - timeout
+        with self._requests_lock:
+            for rid, pending in self._requests.items():
+                if pending.sent > cutoff:
+                    break
+                expired.append(rid)
+            expired = [self._requests.pop(rid) for rid in expired]
+
+        status = status_codes[6][5]
+        for pending in expired:
+            self.parent.server.request_stats.timed_out(pending.command)
+            self.parent.print("ERROR: '%s' received no response after %i seconds" % (pending.command, timeout))
+
+            response = pending.command[:-len("Request")] + "Response"
+            if response in self._handlers:
+                self.dispatch(response, pending.context, {}, status, pending.origin)
+            else:
+                (pending.origin or self.parent).error("The chat API did not respond to %s" % pending.command)
+
+    def send_chat(self, message, mtype="channel", target=None, client=None):
         payload = {"message": message}
 
         mtype = mtype.lower()
@@ -208,17 +684,17 @@ class CapiClient(Thread):
             if mtype == "whisper":
                 user = self.get_user(target)
                 if user is None:
-                    self.parent.error(bncs.ERROR_NOTLOGGEDON)
+                    (client or self.parent).error(bncs.ERROR_NOTLOGGEDON)
                     return False
                 else:
                     payload["user_id"] = user.id
 
-            return self.send_command(send_message_types.get(mtype), payload)
+            return self.send_command(send_message_types.get(mtype), payload, client)
 
-    def bankickunban(self, target, action="ban"):
+    def bankickunban(self, target, action="ban", client=None):
         user = self.get_user(target)
         if action.lower() != "unban" and user is None:
-            self.parent.error(bncs.ERROR_NOTLOGGEDON)
+            (client or self.parent).error(bncs.ERROR_NOTLOGGEDON)
             return False
         else:
             action = bku_actions.get(action.lower())
@@ -226,9 +702,39 @@ class CapiClient(Thread):
                 raise ValueError("Invalid ban/kick/unban action - must be %s" % ', '.join(bku_actions.keys()))
 
             payload = {"toon_name": target} if user is None else {"user_id": user.id}
-            return self.send_command(action, payload)
+            return self.send_command(action, payload, client)
 
     def run(self):
+        # Receives until the connection closes, then keeps reconnecting for as long as the session should.
+        while self._receive():
+            if not self._reconnect():
+                return
+
+    def _reconnect(self):
+        # Returns True once connected again, or False if the session has stopped reconnecting.
+        while True:
+            delay = self.reconnect_delay()
+            if delay is None:
+                return False
+            time.sleep(delay)
+
+            if not self.reconnecting:
+                return False
+            try:
+                sock = open_websocket(self.endpoint)
+            except (websocket.WebSocketException, OSError):
+                continue
+
+            if not self.reconnecting:
+                # Every client left while connecting
+                sock.close()
+                return False
+            self.attach(sock)
+            self.resume()
+            return True
+
+    def _receive(self):
+        # Returns True if the connection was lost and the session is reconnecting.
         while self.connected():
             try:
                 opcode, data = self.socket.recv_data(True)
@@ -238,109 +744,277 @@ class CapiClient(Thread):
                     # We can keep going after this it shouldn't be an issue.
                     continue
                 else:
-                    self.disconnect("CAPI receive failed: %s" % ex)
-                    return
+                    return self.lost("CAPI receive failed: %s" % ex)
 
-            self.last_talk = datetime.now()
+            self.last_talk = time.monotonic()
 
             # Check for certain control messages.
             if opcode != websocket.ABNF.OPCODE_TEXT:
                 # Ignore these we just needed to record the time.
                 continue
 
-            msg = data.decode('utf-8')
+            self.handle_message(data)
 
-            try:
-                obj = json.loads(msg)
-            except json.JSONDecodeError:
-                self.parent.print("Received CAPI message with invalid JSON: %s" % msg)
-                # This might not be the end of the world. Don't give up just yet.
-                continue
+        if not self.reconnecting:
+            self.finish()
+        return self.reconnecting
 
-            if not (obj and isinstance(obj, dict)):
-                self.parent.print("Received invalid CAPI message (length: %i)" % len(msg))
-            else:
-                rid = obj.get("request_id")
-                command = obj.get("command")
-                status = obj.get("status")
-                payload = obj.get("payload")
+    def finish(self):
+        # Called once the receive loop for this connection has ended, unless it's reconnecting
+        if self._released:
+            return
 
-                # Convert status codes to message
-                if status:
-                    area = status.get("area")
-                    code = status.get("code")
+        if self._authenticating:
+            self._unregister()
+            for client in self._end_authentication():
+                client.bncs.send_logon_response(False, "API key invalid")
+            self.parent.print("Authentication failed - API key rejected")
+        else:
+            self.lost("CAPI thread exited")
+
+    def handle_message(self, data):
+        self.messages_received += 1
+        self.bytes_received += len(data)
 
-                    status = status_codes.get(area)
-                    status = status and status.get(code)
-                    if not status:
-                        status = "Unknown (%i-%i)" % (area, code)
+        # Data is parsed straight from the received bytes, without decoding it to a string first.
+        try:
+            obj = codec.loads(data)
+        except codec.DecodeError:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8', 'replace')
+            self.parent.print("Received CAPI message with invalid JSON: %s" % data)
+            # This might not be the end of the world. Don't give up just yet.
+            return
 
-                self.parent.debug("Received CAPI command: %s%s" %
-                                  (command, ('' if status is None else (" (status: %s)" % str(status)))))
+        if not (obj and isinstance(obj, dict)):
+            self.parent.print("Received invalid CAPI message (length: %i)" % len(data))
+        else:
+            origin = None
+            rid = obj.get("request_id")
+            command = obj.get("command")
+            status = obj.get("status")
+            payload = obj.get("payload")
+
+            # Convert status codes to message
+            limited = False
+            if status:
+                area = status.get("area")
+                code = status.get("code")
+                limited = (area == 6 and code == 8)
+
+                status = status_codes.get(area)
+                status = status and status.get(code)
+                if not status:
+                    status = "Unknown (%i-%i)" % (area, code)
+
+            if self.parent.debugging:
+                self.parent.debug("Received CAPI command: %s%s", command,
+                                  '' if status is None else (" (status: %s)" % str(status)))
 
                 if len(payload) > 0:
-                    self.parent.debug("Payload: %s" % payload)
-
-                if status:
-                    self.parent.print("ERROR: '%s' received status: '%s'" % (command, status))
-
-                # Find the request for this message.
-                request = None
-                if "Event" not in command:
-                    # Events do not have requests directly associated with them.
-                    if rid in self._requests:
-                        request = self._requests.get(rid).get("payload")
-                        del self._requests[rid]
-                    else:
-                        self.parent.print("Received unexpected response to request ID %i" % rid)
+                    self.parent.debug("Payload: %s", payload)
 
-                # Run the command handler, if available.
-                if command in self._handlers:
-                    try:
-                        self._handlers.get(command)(request, payload, status)
-                    except Exception as ex:
-                        self.parent.print("ERROR! Something happened while processing CAPI command '%s'." % command)
-                        self.parent.print("ERROR!   Status: %s" % status)
-                        self.parent.print("ERROR!   Payload: %s" % payload)
-                        self.parent.print("ERROR!   Request: %s" % request)
-                        self.parent.print("ERROR!   Exception: %s" % ex)
+            if status:
+                self.parent.print("ERROR: '%s' received status: '%s'" % (command, status))
 
-                        if self.parent.server.debug:
-                            raise
+            # Find the request for this message.
+            request = None
+            if "Event" not in command:
+                # Events do not have requests directly associated with them.
+                with self._requests_lock:
+                    pending = self._requests.pop(rid, None)
 
-        if self._authenticating:
-            self.parent.bncs.send_logon_response(False, "API key invalid")
-            self.parent.print("Authentication failed - API key rejected")
-            self._authenticating = False
-        else:
-            self.disconnect("CAPI thread exited")
+                if pending is None:
+                    self.parent.print("Received response to unknown or expired request ID %s" % rid)
+                else:
+                    request = pending.context
+                    origin = pending.origin
+                    self.parent.server.request_stats.observe(pending.command, time.monotonic() - pending.sent)
+
+                    if pending.command in request_priorities:
+                        if limited:
+                            self.outbox.rate_limited()
+                        else:
+                            self.outbox.succeeded()
+
+            self.dispatch(command, request, payload, status, origin)
+
+    def dispatch(self, command, request, payload, status, origin=None):
+        # Run the command handler, if available. 'origin' is the client that sent the request being responded to.
+        if command in self._handlers:
+            # Any BNCS packets this creates are sent together once it's done.
+            started = time.perf_counter()
+            with self._relay_lock:
+                listeners = self.listeners
+                for client in listeners:
+                    client.bncs.hold()
+                try:
+                    self._handlers.get(command)(request, payload, status, origin)
+                except Exception as ex:
+                    self.parent.print("ERROR! Something happened while processing CAPI command '%s'." % command)
+                    self.parent.print("ERROR!   Status: %s" % status)
+                    self.parent.print("ERROR!   Payload: %s" % payload)
+                    self.parent.print("ERROR!   Request: %s" % request)
+                    self.parent.print("ERROR!   Exception: %s" % ex)
+
+                    if self.parent.server.debug:
+                        raise
+                finally:
+                    for client in listeners:
+                        client.bncs.release()
+                    self.handler_time += time.perf_counter() - started
+
+    def relay(self, eid, username, text, flags=0, encoding='utf-8', errors=None):
+        # Sends a chat event to every client in the channel. The packet is only put together once.
+        data = bncs.chat_event(eid, username, text, flags, 0, encoding, errors)
+        for client in self.listeners:
+            client.bncs.send_chat_event(eid, username, data)
 
     def authenticate(self, api_key):
         self.api_key = api_key
         self._authenticating = True
+
+        server = self.parent.server
+        while server.share_sessions:
+            with server.sessions_lock:
+                session = server.sessions.get(api_key)
+                if session is None or session._closed or not (session.connected() or session.reconnecting):
+                    server.sessions[api_key] = self
+                    break
+
+            # Another client is already logged on with this key, so its session is used instead of this connection.
+            if session.join(self.parent):
+                self.parent.capi = session
+                session.connects += self.connects
+                self._authenticating = False
+                self._release()
+                return
+
         self.send_command("Botapiauth.AuthenticateRequest", {"api_key": api_key})
 
-    def _handle_auth_response(self, request, response, error):
-        self._authenticating = False
+    def _end_authentication(self):
+        # Returns the clients waiting for the result of authenticating
+        with self._clients_lock:
+            self._authenticating = False
+            return self.clients
+
+    def enter_chat(self, client):
+        """Enters chat for a client. If the session is already in chat, the client is sent the channel and its users."""
+        with self._relay_lock:
+            if client not in self.listeners and client not in self._resync_waiting:
+                if self.username is not None:
+                    client.bncs.hold()
+                    try:
+                        client.bncs.enter_chat(self.username, self.statstring)
+                        if self.channel and self._resync is None:
+                            self._send_channel(client)
+                    finally:
+                        client.bncs.release()
+
+                with self._clients_lock:
+                    if self._resync is not None:
+                        # The channel is being listed again after reconnecting, so it's sent once that's finished.
+                        self._resync_waiting = self._resync_waiting + [client]
+                    else:
+                        self.listeners = self.listeners + [client]
+
+        if not self._connect_sent:
+            self._connect_sent = True
+            self.send_command("Botapichat.ConnectRequest")
+
+    def _send_channel(self, client):
+        # Sends the channel and the users listed so far to a client entering chat
+        client.bncs.send_chat(bncs.EID_CHANNEL, self.username, self.channel)
+        for user in list(self.users.values()):
+            if user.id != 1 or self._received_users:
+                client.bncs.send_chat(bncs.EID_SHOWUSER, user.encoded_name, user.statstring, user.flag_int)
+
+    def _handle_auth_response(self, request, response, error, origin=None):
+        if self.reconnecting:
+            self._rejoin(error)
+            return
+
+        self._authenticated = not error
+        for client in self._end_authentication():
+            if error:
+                client.bncs.send_logon_response(False, str(error))
+            else:
+                # Login successful
+                client.bncs.send_logon_response(True)
+
         if error:
-            self.parent.bncs.send_logon_response(False, str(error))
             self.disconnect("CAPI authentication failed: %s" % error)
-        else:
-            # Login successful
-            self.parent.bncs.send_logon_response(True)
 
-    def _handle_connect_response(self, request, response, error):
+    def _rejoin(self, error):
+        # Handles logging on again after reconnecting. The clients are already logged on, so they aren't told.
+        self.reconnecting = False
+        if error:
+            self.disconnect("CAPI authentication failed: %s" % error)
+            return
+
+        self.parent.print("Reconnected to the chat API")
+        self.relay(bncs.EID_INFO, bncs.GATEWAY_USER, "Reconnected to the chat API.")
+        if self._connect_sent:
+            # The channel is listed again, and compared with what the clients already have once it's complete.
+            self._resync = self.user_names
+            self._resync_channel = self.channel
+            self.users = {}
+            self.user_names = {}
+            self.channel = None
+            self._received_users = False
+            self.send_command("Botapichat.ConnectRequest")
+
+    def _resync_event(self, user):
+        # Returns the event to send for a user listed after reconnecting, or None if the clients already know them.
+        old = self._resync.pop(normalize_name(user.name), None) if user.name else None
+        if old is None:
+            return bncs.EID_JOIN
+        elif old.flags != user.flags or old.statstring != user.statstring:
+            return bncs.EID_USERFLAGS
+        return None
+
+    def _finish_resync(self):
+        # Users that weren't listed again left while the session was disconnected
+        for user in self._resync.values():
+            self.relay(bncs.EID_LEAVE, user.encoded_name, b'', user.flag_int)
+        self._resync = None
+
+        # Clients that entered chat in the meantime get the whole channel
+        with self._clients_lock:
+            waiting = self._resync_waiting
+            self._resync_waiting = []
+        for client in waiting:
+            client.bncs.hold()
+            try:
+                self._send_channel(client)
+            finally:
+                client.bncs.release()
+
+        with self._clients_lock:
+            self.listeners = self.listeners + [c for c in waiting if c in self.clients]
+
+    def _handle_connect_response(self, request, response, error, origin=None):
         if error:
             self.disconnect("Failed to enter chat: %s" % error)
 
-    def _handle_connect_event(self, request, response, error):
+    def _handle_connect_event(self, request, response, error, origin=None):
         self.channel = response.get("channel")
-        self.parent.bncs.send_chat(bncs.EID_CHANNEL, self.username, self.channel)
-
-    def _handle_disconnect_event(self, request, response, error):
+        if self._resync is not None:
+            if self.channel == self._resync_channel:
+                return
+
+            # Clients clear their user lists when they're told about a different channel, so there's nothing to compare.
+            #   Clients waiting for the resync get the new channel listing along with the others.
+            self._resync = None
+            with self._clients_lock:
+                self.listeners = self.listeners + self._resync_waiting
+                self._resync_waiting = []
+        self.relay(bncs.EID_CHANNEL, self.username, self.channel)
+
+    def _handle_disconnect_event(self, request, response, error, origin=None):
         self.disconnect("Disconnected from chat API")
 
-    def _handle_user_update_event(self, request, response, error):
+    def _handle_user_update_event(self, request, response, error, origin=None):
         user_id = response.get("user_id")
         toon_name = response.get("toon_name")
         attributes = response.get("attribute")
@@ -351,28 +1025,41 @@ class CapiClient(Thread):
         if not self.channel:
             # We're not in a channel yet, so this should be our own info.
             self.username = user.name
-            self.parent.bncs.enter_chat(self.username, get_statstring(user.attributes))
+            self.statstring = user.statstring
+            if self._resync is not None:
+                # Entering chat again after reconnecting, which the clients don't need to know about
+                self._resync.pop(normalize_name(user.name), None)
+            else:
+                for client in self.listeners:
+                    client.bncs.enter_chat(self.username, self.statstring)
         else:
             if user.id in self.users:
                 changes = False
 
-                # Actually an update
-                if flags or attributes:
-                    eid = bncs.EID_USERFLAGS
-
-                    if flags and user.flags != flags:
-                        user.flags = flags
-                        changes = True
+                if user.id == 1 and not self._received_users:
+                    # It's us, which ends the channel listing, so we can switch to joins instead of show user.
+                    #   This is checked first because it can come with an empty list of flags.
+                    if flags is not None:
+                        user.set_flags(flags)
                     if attributes:
-                        old_attr = user.attributes
                         user.set_attributes(attributes)
-                        if user.attributes != old_attr:
-                            changes = True
-                elif user.id == 1 and not self._received_users:
-                    # It's us so we can switch to joins instead of show user
+
                     eid = bncs.EID_SHOWUSER
                     self._received_users = True
                     changes = True
+
+                    if self._resync is not None:
+                        # The clients already have us in their lists
+                        self._finish_resync()
+                        return
+                elif flags is not None or attributes:
+                    # Actually an update. An empty list of flags means they have all been removed.
+                    eid = bncs.EID_USERFLAGS
+
+                    if flags is not None and user.set_flags(flags):
+                        changes = True
+                    if attributes and user.set_attributes(attributes):
+                        changes = True
                 else:
                     eid = None      # Satisfies an assignment check
 
@@ -380,47 +1067,51 @@ class CapiClient(Thread):
                     # It's an update where nothing changed??
                     self.parent.print("Received user update with no changes")
                     return
+            elif self._resync is not None:
+                # Listed again after reconnecting, so only users that joined or changed in the meantime are sent
+                eid = self._resync_event(user)
             else:
                 eid = bncs.EID_JOIN if self._received_users else bncs.EID_SHOWUSER
 
             # Relay the event
-            self.parent.bncs.send_chat(eid, user.name, user.get_statstring(), user.get_flags())
+            if eid is not None:
+                self.relay(eid, user.encoded_name, user.statstring, user.flag_int)
 
-        self.users[user.id] = user
+        self.add_user(user)
         if len(user.attributes) > 0:
             if len(user.attributes) > 1 or "ProgramId" not in user.attributes:
                 self.parent.print("Attribute(s) found for user '%s': %s" % (user.name, attributes))
 
-    def _handle_user_leave_event(self, request, response, error):
+    def _handle_user_leave_event(self, request, response, error, origin=None):
         user = self.get_user(response.get("user_id"))
         if user:
-            self.parent.bncs.send_chat(bncs.EID_LEAVE, user.name, '', get_flag_int(user.flags))
-            del self.users[user.id]
+            self.relay(bncs.EID_LEAVE, user.encoded_name, b'', user.flag_int)
+            self.remove_user(user)
         else:
             self.parent.print("Received leave event for unknown user")
 
-    def _handle_message_event(self, request, response, error):
+    def _handle_message_event(self, request, response, error, origin=None):
         user = self.get_user(response.get("user_id"))
         mtype = response.get("type")
         message = response.get("message")
 
         eid = message_eids.get(mtype.lower())
         if eid is not None:
-            flags = get_flag_int(user.flags)
             # String encoding problems... try UTF-8, then latin-1 and use character replacing
             try:
-                self.parent.bncs.send_chat(eid, user.name, message, flags)
+                self.relay(eid, user.encoded_name, message, user.flag_int)
             except UnicodeEncodeError:
-                self.parent.bncs.send_chat(eid, user.name, message, flags,
-                                           encoding='latin-1', errors=self.parent.server.encoding_errors)
+                self.relay(eid, user.encoded_name, message, user.flag_int,
+                           encoding='latin-1', errors=self.parent.server.encoding_errors)
         else:
             self.parent.print("Unrecognized chat message type (%s: %s)" % (mtype, message))
 
-    def _handle_send_whisper_response(self, request, response, error):
+    def _handle_send_whisper_response(self, request, response, error, origin=None):
+        client = origin or self.parent
         if error:
-            self.parent.error("Whisper not sent: %s" % error)
+            client.error("Whisper not sent: %s" % error)
         else:
             target = self.get_user(request.get("user_id"))
             message = request.get("message")
             if target:
-                self.parent.bncs.send_chat(bncs.EID_WHISPERSENT, target.name, message)
+                client.bncs.send_chat(bncs.EID_WHISPERSENT, target.name, message)
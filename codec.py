@@ -0,0 +1,88 @@
+
+# JSON encoding for chat API messages.
+#   A faster library is used when one is installed, otherwise the standard json module.
+
+import json
+
+
+def _stdlib_backend():
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return json.loads, dumps
+
+
+def _orjson_backend():
+    import orjson
+    return orjson.loads, orjson.dumps
+
+
+def _ujson_backend():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    return ujson.loads, dumps
+
+
+# In order of preference
+backends = {
+    "orjson": _orjson_backend,
+    "ujson": _ujson_backend,
+    "json": _stdlib_backend
+}
+
+# All of the backends raise a subclass of this for invalid input
+DecodeError = ValueError
+
+backend = None
+loads = None
+dumps = None
+
+_prefixes = {}
+
+
+def available():
+    """Returns the names of the backends that can be used."""
+    names = []
+    for name, factory in backends.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def use(name=None):
+    """Selects the backend to use. If no name is given the fastest one available is chosen."""
+    global backend, loads, dumps
+
+    for option in ([name] if name else backends.keys()):
+        factory = backends.get(option)
+        if factory is None:
+            raise ValueError("Unknown JSON backend: %s" % option)
+
+        try:
+            loads, dumps = factory()
+        except ImportError:
+            if name:
+                raise
+            continue
+
+        backend = option
+        return backend
+
+
+def encode_request(command, request_id, payload):
+    """Serializes a chat API request as UTF-8 JSON bytes.
+
+    Everything before the request ID only depends on the command, so it is serialized once and reused.
+    """
+    prefix = _prefixes.get(command)
+    if prefix is None:
+        prefix = _prefixes[command] = b'{"command":' + dumps(command) + b',"request_id":'
+
+    return b''.join((prefix, str(request_id).encode('ascii'), b',"payload":', dumps(payload), b'}'))
+
+
+use()
@@ -12,31 +12,140 @@ parser.add_argument('--ignore-unsupported', help='Silently drops unsupported com
 parser.add_argument('--do-version-check', help='Sends version check requests to clients.', action='store_true')
 parser.add_argument('--out-format', help='Specifies the format to use when printing console messages.')
 parser.add_argument('--debug-format', help='Specifies the format to use when printing debug messages.')
+parser.add_argument('--log-file', help='Writes console messages to a file instead of the console')
+parser.add_argument('--log-max-bytes', help='Rotates the log file once it reaches this size', type=int)
+parser.add_argument('--log-backups', help='Number of rotated log files to keep', type=int)
+parser.add_argument('--log-json', help='Writes console messages as JSON lines', action='store_true')
+parser.add_argument('--flush-threshold', help='Sends held BNCS packets once this many bytes are waiting', type=int)
+parser.add_argument('--flush-delay', help='Maximum seconds to hold BNCS packets before sending them', type=float)
+parser.add_argument('--queue-limit', help='Maximum bytes waiting to be sent to a BNCS client', type=int)
+parser.add_argument('--queue-policy', help='What to do when a BNCS client falls behind',
+                    choices=['disconnect', 'drop', 'coalesce'])
+parser.add_argument('--capi-endpoint', help='Connects to a different chat API websocket URL, such as a test server')
+parser.add_argument('--capi-rate', type=float,
+                    help='Chat messages and moderation requests sent per second, per session (0 for no limit)')
+parser.add_argument('--capi-burst', help='Chat API requests that can be sent at once before rate limiting', type=int)
+parser.add_argument('--backlog', help='Connections the operating system holds until they are accepted', type=int)
+parser.add_argument('--setup-workers', help='Clients connected to the chat API at the same time', type=int)
+parser.add_argument('--setup-limit', help='Clients that can wait to be connected to the chat API', type=int)
+parser.add_argument('--capi-pool', help='Chat API connections to keep open ahead of time for new clients', type=int)
+parser.add_argument('--capi-reconnect', help='Reconnects to the chat API instead of disconnecting clients',
+                    action='store_true')
+parser.add_argument('--share-sessions', help='Clients using the same API key share one chat API session',
+                    action='store_true')
+parser.add_argument('--metrics', help='Serves Prometheus metrics on [host:]port or unix:path')
+parser.add_argument('--workers', help='Runs this many server processes sharing the port (not on Windows)', type=int,
+                    default=1)
+parser.add_argument('--asyncio', help='Runs all connections on a single asyncio event loop', action='store_true')
 
 args = parser.parse_args()
 
-if args.interface is None:
-    s = Server()
-else:
-    if ':' in args.interface:
-        iface = tuple(args.interface.split(':', maxsplit=1))
-        s = Server(iface[1], iface[0])
+if args.capi_rate is not None and args.capi_rate < 0:
+    parser.error("--capi-rate must be 0 (no limit) or more")
+if args.capi_burst is not None and args.capi_burst < 1:
+    parser.error("--capi-burst must be at least 1")
+
+server_type = Server
+if args.asyncio:
+    from aioserver import AsyncServer
+    server_type = AsyncServer
+
+
+def create_server(worker=None):
+    # Creates a server with the settings given on the command line. Workers share the port with each other.
+    reuse_port = worker is not None
+    if args.interface is None:
+        s = server_type(reuse_port=reuse_port)
     else:
-        s = Server(args.interface)
+        if ':' in args.interface:
+            iface = tuple(args.interface.split(':', maxsplit=1))
+            s = server_type(int(iface[1]), iface[0], reuse_port)
+        else:
+            s = server_type(iface=args.interface, reuse_port=reuse_port)
+
+    if args.debug:
+        s.debug = True
+
+    if args.ignore_unsupported:
+        s.ignore_unsupported_commands = True
+
+    if args.do_version_check:
+        s.do_version_check = True
+
+    if args.out_format:
+        s.out_format = args.out_format
+
+    if args.debug_format:
+        s.debug_format = args.debug_format
+
+    if args.log_file:
+        # Each worker needs its own file, so they don't rotate it out from under each other
+        s.log_file = args.log_file if worker is None else "%s.%i" % (args.log_file, worker)
+
+    if args.log_max_bytes is not None:
+        s.log_max_bytes = args.log_max_bytes
+
+    if args.log_backups is not None:
+        s.log_backups = args.log_backups
+
+    if args.log_json:
+        s.log_json = True
 
-if args.debug:
-    s.debug = True
+    if args.flush_threshold is not None:
+        s.flush_threshold = args.flush_threshold
 
-if args.ignore_unsupported:
-    s.ignore_unsupported_commands = True
+    if args.flush_delay is not None:
+        s.flush_delay = args.flush_delay
 
-if args.do_version_check:
-    s.do_version_check = True
+    if args.queue_limit is not None:
+        s.queue_max_bytes = args.queue_limit
 
-if args.out_format:
-    s.out_format = args.out_format
+    if args.queue_policy:
+        s.queue_policy = args.queue_policy
 
-if args.debug_format:
-    s.debug_format = args.debug_format
+    if args.capi_endpoint:
+        s.capi_endpoint = args.capi_endpoint
+
+    if args.backlog is not None:
+        s.backlog = args.backlog
+
+    if args.setup_workers is not None:
+        s.setup_workers = args.setup_workers
+
+    if args.setup_limit is not None:
+        s.max_setups = args.setup_limit
+
+    if args.capi_pool is not None:
+        s.capi_pool_size = args.capi_pool
+
+    if args.capi_reconnect:
+        s.capi_reconnect = True
+
+    if args.share_sessions:
+        s.share_sessions = True
+
+    if args.capi_rate is not None:
+        s.capi_rate = args.capi_rate
+
+    if args.capi_burst is not None:
+        s.capi_burst = args.capi_burst
+
+    return s
+
+
+if args.workers > 1:
+    import workers
+    if not workers.supported():
+        parser.error("--workers is not supported on this system")
+
+    supervisor = workers.Supervisor(args.workers, create_server)
+    supervisor.metrics_address = args.metrics
+    supervisor.run()
+else:
+    s = create_server()
+    s.start()
 
-s.start()
+    if args.metrics:
+        import metrics
+        metrics.start(s, args.metrics)
+        s.print("[Server] Metrics available at %s" % args.metrics)
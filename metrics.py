@@ -0,0 +1,201 @@
+
+# Serves server statistics in the Prometheus text format, over HTTP on a TCP port or a Unix socket.
+#   Totals are counters; use rate() (or compare two readings) to get per-second figures.
+
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Thread
+import os
+
+
+PREFIX = "capidaptor_"
+
+# Client totals that are exported as counters: name -> help text
+counters = {
+    "bncs_packets_received": "BNCS packets received from clients",
+    "bncs_bytes_received": "BNCS bytes received from clients",
+    "bncs_packets_sent": "BNCS packets sent to clients",
+    "bncs_bytes_sent": "BNCS bytes sent to clients",
+    "bncs_packets_dropped": "BNCS packets dropped or replaced because a client fell behind",
+    "bncs_handler_seconds": "Time spent handling BNCS packets",
+    "capi_connects": "Chat API connections made",
+    "capi_messages_received": "Chat API messages received",
+    "capi_bytes_received": "Chat API bytes received",
+    "capi_messages_sent": "Chat API requests sent",
+    "capi_bytes_sent": "Chat API bytes sent",
+    "capi_handler_seconds": "Time spent handling chat API messages",
+    "capi_rate_limited": "Chat API requests rejected by the API's rate limit",
+    "capi_requests_rejected": "Chat API requests not sent because too many were waiting"
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _add(lines, name, kind, text, samples):
+    # samples is a list of (suffix, labels, value)
+    lines.append("# HELP %s%s %s" % (PREFIX, name, text))
+    lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+    for suffix, labels, value in samples:
+        lines.append("%s%s%s%s %s" % (PREFIX, name, suffix, _labels(labels), repr(float(value))))
+
+
+def collect(server):
+    """Returns the current metrics for a server as Prometheus text."""
+    lines = []
+    clients = server.clients.values()
+
+    _add(lines, "clients", "gauge", "Connected clients", [('', None, len(clients))])
+    _add(lines, "clients_connecting", "gauge", "Clients waiting to be connected to the chat API",
+         [('', None, server.setups)])
+
+    totals = server.counters()
+    for name, text in counters.items():
+        _add(lines, name + "_total", "counter", text, [('', None, totals.get(name, 0))])
+
+    # Queue depths, summed over every connected client. Clients can share a chat API session.
+    bncs_packets = bncs_bytes = capi_waiting = capi_pending = 0
+    sessions = {}
+    for client in clients:
+        bncs_packets += len(client.bncs.outbound)
+        bncs_bytes += client.bncs.outbound.size
+        sessions[id(client.capi)] = client.capi
+
+    for capi in sessions.values():
+        capi_waiting += len(capi.outbox)
+        capi_pending += capi.pending_requests()
+
+    _add(lines, "capi_sessions", "gauge", "Chat API sessions used by connected clients", [('', None, len(sessions))])
+
+    _add(lines, "bncs_queued_packets", "gauge", "BNCS packets waiting to be sent", [('', None, bncs_packets)])
+    _add(lines, "bncs_queued_bytes", "gauge", "BNCS bytes waiting to be sent", [('', None, bncs_bytes)])
+    _add(lines, "capi_queued_requests", "gauge", "Chat API requests waiting for the rate limit",
+         [('', None, capi_waiting)])
+    _add(lines, "capi_pending_requests", "gauge", "Chat API requests waiting for a response",
+         [('', None, capi_pending)])
+
+    with server._stats_lock:
+        reasons = dict(server.close_reasons)
+    _add(lines, "client_closes_total", "counter", "Clients disconnected, by reason",
+         [('', [("reason", r)], count) for r, count in sorted(reasons.items())])
+
+    latency, timeouts = server.request_stats.snapshot()
+    samples = []
+    for command, h in sorted(latency.items()):
+        seen = 0
+        for bound, count in zip(h.bounds + ("+Inf",), h.buckets):
+            seen += count
+            samples.append(("_bucket", [("command", command), ("le", bound)], seen))
+        samples.append(("_sum", [("command", command)], h.sum))
+        samples.append(("_count", [("command", command)], h.count))
+    _add(lines, "capi_request_seconds", "histogram", "Chat API request round-trip times", samples)
+
+    _add(lines, "capi_request_timeouts_total", "counter", "Chat API requests that received no response",
+         [('', [("command", c)], count) for c, count in sorted(timeouts.items())])
+
+    pool = server.capi_pool
+    if pool is not None:
+        _add(lines, "capi_pool_idle", "gauge", "Chat API connections waiting in the pool", [('', None, len(pool))])
+        _add(lines, "capi_pool_hits_total", "counter", "Clients given a connection from the pool",
+             [('', None, pool.hits)])
+        _add(lines, "capi_pool_misses_total", "counter", "Clients that connected themselves as the pool was empty",
+             [('', None, pool.misses)])
+        _add(lines, "capi_pool_failures_total", "counter", "Failed attempts to open a connection for the pool",
+             [('', None, pool.failures)])
+
+    if server.output is not None:
+        _add(lines, "log_messages_dropped_total", "counter", "Console messages dropped because output was too slow",
+             [('', None, server.output.dropped)])
+
+    return '\n'.join(lines) + '\n'
+
+
+def combine(texts):
+    """Adds up the samples with the same name and labels from several metrics texts, such as one from each worker."""
+    families = {}       # Metric name -> [comment lines, {sample key: value}], in the order they were first seen
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                family = families.setdefault(line.split(' ')[2], [[], {}])
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line.startswith("# TYPE "):
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                key, _, value = line.rpartition(' ')
+                family[1][key] = family[1].get(key, 0.0) + float(value)
+
+    lines = []
+    for comments, samples in families.values():
+        lines.extend(comments)
+        lines.extend("%s %s" % (key, repr(value)) for key, value in samples.items())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    timeout = 5     # Seconds, so a slow client can't hold up a server that handles one request at a time
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = self.server.collect().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(UnixStreamServer):
+    def get_request(self):
+        # The request handler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixHTTPServer):
+    daemon_threads = True
+
+
+def start(server, address):
+    """Serves metrics for 'server' in the background. Address can be [host:]port or unix:path."""
+    return serve(address, lambda: collect(server))
+
+
+def create(address, func, threaded=True):
+    # Creates a server for the text returned by func(), without running it. If threaded, each request is handled on
+    #   its own thread.
+    if address.startswith("unix:"):
+        path = address[5:]
+        if os.path.exists(path):
+            os.remove(path)
+        httpd = (ThreadingUnixHTTPServer if threaded else UnixHTTPServer)(path, MetricsHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        httpd = (ThreadingHTTPServer if threaded else HTTPServer)((host or "127.0.0.1", int(port)), MetricsHandler)
+
+    httpd.collect = func
+    return httpd
+
+
+def serve(address, func):
+    # Serves the text returned by func() for each request, in the background
+    httpd = create(address, func)
+    thread = Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
@@ -0,0 +1,169 @@
+
+import codec
+
+from threading import Thread
+from datetime import datetime
+from queue import Queue, Full
+import os
+import re
+import sys
+import time
+
+
+# Placeholders that can be used in console message formats
+_fields = re.compile(r'%(message|client_id|ip|name|channel)')
+
+
+def get_fields(client, message, fields):
+    values = {}
+    for field in fields:
+        if field == "message":
+            values[field] = str(message)
+        elif field == "client_id":
+            values[field] = str(client.id)
+        elif field == "ip":
+            values[field] = str(client.address[0])
+        elif field == "name":
+            values[field] = str(client.capi.username or '')
+        elif field == "channel":
+            values[field] = str(client.capi.channel or '')
+    return values
+
+
+class Template(object):
+    """A console message format, compiled once into a str.format() string.
+
+    Placeholders are filled from the record, and anything else containing '%' is treated as a strftime code. Times are
+    only formatted once per second.
+    """
+    fields_all = ["message", "client_id", "ip", "name", "channel"]
+
+    def __init__(self, fmt):
+        self.source = fmt
+        self.fields = []
+        self.time_parts = []
+
+        pieces = []
+        for i, piece in enumerate(_fields.split(fmt)):
+            if i % 2 == 1:
+                pieces.append('{%s}' % piece)
+                if piece not in self.fields:
+                    self.fields.append(piece)
+            elif '%' in piece:
+                # Time formatting codes: https://docs.python.org/3/library/datetime.html#strftime-strptime-behavior
+                pieces.append('{_t%i}' % len(self.time_parts))
+                self.time_parts.append(piece)
+            else:
+                pieces.append(piece.replace('{', '{{').replace('}', '}}'))
+        self.format = ''.join(pieces)
+
+        self._time_key = None
+        self._time_values = {}
+
+    def render(self, values, timestamp):
+        if len(self.time_parts) > 0:
+            second = int(timestamp)
+            if second != self._time_key:
+                dt = datetime.fromtimestamp(second)
+                self._time_values = {('_t%i' % i): dt.strftime(part) for i, part in enumerate(self.time_parts)}
+                self._time_key = second
+            return self.format.format(**values, **self._time_values)
+        return self.format.format(**values)
+
+
+class LogSink(Thread):
+    """Writes console messages from a background thread so that slow output doesn't hold up connections.
+
+    Messages go to stdout, or to a file that is rotated once it reaches max_bytes (if set), either as plain text or as
+    JSON lines. If more than max_queue messages are waiting, new ones are dropped and counted.
+    """
+    def __init__(self, path=None, max_bytes=0, backups=3, json_lines=False, max_queue=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.json_lines = json_lines
+
+        self.queue = Queue(max_queue)
+        self.dropped = 0
+        self.written = 0
+
+        self._stream = None
+        self._size = 0
+
+        super().__init__()
+        self.daemon = True
+
+    def write(self, level, template, client, message):
+        """Queues a message. Returns False if it had to be dropped."""
+        timestamp = time.time()
+        if client is None:
+            values = {"message": str(message)}
+        else:
+            values = get_fields(client, message, Template.fields_all if self.json_lines else template.fields)
+
+        try:
+            self.queue.put_nowait((level, template, values, timestamp))
+            return True
+        except Full:
+            self.dropped += 1
+            return False
+
+    def _open(self):
+        if self.path is None:
+            self._stream = sys.stdout
+        else:
+            self._stream = open(self.path, 'a', encoding='utf-8', errors='replace')
+            self._size = self._stream.tell()
+
+    def _rotate(self):
+        self._stream.close()
+
+        for i in range(self.backups - 1, 0, -1):
+            src = "%s.%i" % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, "%s.%i" % (self.path, i + 1))
+
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _format(self, level, template, values, timestamp):
+        if self.json_lines:
+            values["time"] = datetime.fromtimestamp(timestamp).isoformat()
+            values["level"] = level
+            return codec.dumps(values).decode('utf-8')
+        elif template is None:
+            return values["message"]
+        else:
+            return template.render(values, timestamp)
+
+    def _emit(self, line):
+        self._stream.write(line + '\n')
+        self.written += 1
+
+        if self.path is not None and self.max_bytes > 0:
+            self._size += len(line) + 1
+            if self._size >= self.max_bytes:
+                self._rotate()
+
+    def run(self):
+        self._open()
+        reported = 0
+
+        while True:
+            record = self.queue.get()
+            try:
+                self._emit(self._format(*record))
+            except (OSError, ValueError, KeyError) as ex:
+                sys.stderr.write("[Server] ERROR! Unable to write log message: %s\n" % ex)
+
+            if self.queue.empty():
+                # Caught up, so report anything that was lost
+                if self.dropped != reported:
+                    message = "[Server] %i log message(s) dropped because output was too slow" % \
+                              (self.dropped - reported)
+                    self._emit(self._format("server", None, {"message": message}, time.time()))
+                    reported = self.dropped
+                self._stream.flush()
@@ -0,0 +1,121 @@
+
+# Keeps chat API websockets connected ahead of time, so a new bot doesn't have to wait for the TCP, TLS and websocket
+#   handshakes before it can log on. Connections that have waited too long are replaced, in case the chat API has
+#   dropped them, and the pool is refilled in the background as connections are handed out.
+
+from capi import open_websocket
+
+from threading import Thread, Lock, Event
+from collections import deque
+import select
+import time
+
+import websocket
+
+
+POOL_MAX_AGE = 30           # Seconds a connection can wait in the pool before it is replaced
+POOL_RETRY_DELAY = 5        # Seconds to wait after failing to connect
+
+
+class CapiPool(object):
+    """Keeps up to 'size' websockets connected to 'endpoint', ready to be handed to new clients.
+
+    Connections are opened one at a time by a background thread. take() returns the oldest usable connection, or None
+    if the pool is empty, in which case the client should connect by itself.
+    """
+    def __init__(self, endpoint, size, max_age=POOL_MAX_AGE):
+        self.endpoint = endpoint
+        self.size = size
+        self.max_age = max_age
+
+        self.idle = deque()         # (time connected, websocket), oldest first
+        self.lock = Lock()
+        self.wakeup = Event()
+
+        # Running totals, for metrics
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def __len__(self):
+        return len(self.idle)
+
+    def start(self):
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def take(self):
+        now = time.monotonic()
+        found = None
+        stale = []
+        with self.lock:
+            while self.idle:
+                connected, ws = self.idle.popleft()
+                if now - connected < self.max_age and self.usable(ws):
+                    found = ws
+                    break
+                stale.append(ws)
+
+        for ws in stale:
+            self.discard(ws)
+
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.wakeup.set()
+        return found
+
+    def _remove_stale(self):
+        now = time.monotonic()
+        stale = []
+        with self.lock:
+            while self.idle and now - self.idle[0][0] >= self.max_age:
+                stale.append(self.idle.popleft()[1])
+        return stale
+
+    def _next_expiry(self):
+        # Seconds until the oldest connection has to be replaced
+        with self.lock:
+            if not self.idle:
+                return None
+            return max(self.idle[0][0] + self.max_age - time.monotonic(), 0)
+
+    def _add(self, ws):
+        with self.lock:
+            self.idle.append((time.monotonic(), ws))
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            for ws in self._remove_stale():
+                self.discard(ws)
+
+            if len(self.idle) >= self.size:
+                self.wakeup.wait(self._next_expiry())
+                continue
+
+            try:
+                ws = self.open()
+            except (websocket.WebSocketException, OSError):
+                self.failures += 1
+                time.sleep(POOL_RETRY_DELAY)
+                continue
+            self._add(ws)
+
+    def open(self):
+        return open_websocket(self.endpoint)
+
+    def usable(self, ws):
+        # The chat API doesn't send anything before a client authenticates, so anything waiting to be read means the
+        #   connection is being closed.
+        if not ws.connected:
+            return False
+        try:
+            return not select.select([ws.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def discard(self, ws):
+        ws.shutdown()
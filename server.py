@@ -1,114 +1,366 @@
 
 from bncs import ThinBncsClient, SID_NULL
-from capi import CapiClient
-
-from threading import Thread, Lock
-from socket import socket, AF_INET, SOCK_STREAM
-from datetime import datetime
+from capi import CapiClient, DEFAULT_ENDPOINT
+from pool import CapiPool
+from timers import Scheduler
+from output import Template, LogSink, get_fields
+from stats import RequestStats
+
+from threading import Thread, Lock, RLock
+from queue import SimpleQueue
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET
+import heapq
+import random
 import time
+import traceback
+
+
+# Connection monitoring intervals, in seconds
+BNCS_PING_AFTER = 30        # Idle time before a BNCS client is pinged
+BNCS_TIMEOUT = 90           # Idle time before a BNCS client is dropped
+BNCS_NULL_INTERVAL = 60     # Time between BNCS NULL packets, regardless of activity
+CAPI_PING_AFTER = 10        # Idle time before the chat API is pinged
+CAPI_TIMEOUT = 30           # Idle time before the chat API connection is dropped
+CAPI_REQUEST_TIMEOUT = 15   # Time to wait for the response to a chat API request
+SETUP_WAIT_TIMEOUT = 30     # Time a new client can wait for its chat API connection to be started
+TIMER_JITTER = 1.0          # Up to this much is added to deadlines at random, so clients aren't all checked together
+
+
+class ClientRegistry(object):
+    """Tracks connected clients and hands out their IDs.
+
+    IDs are reserved when they are handed out and the lowest free ID is always used, as IDs of closed clients are kept
+    in a heap for reuse. Only reserving an ID takes a lock; adding and removing clients are single dictionary
+    operations. New IDs start at 'first' and go up by 'step', so that several registries can share an ID space.
+    """
+    def __init__(self, first=1, step=1):
+        self.clients = {}
+
+        self._lock = Lock()
+        self._free_ids = []
+        self._next_id = first
+        self._step = step
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, client_id):
+        return client_id in self.clients
+
+    def get(self, client_id):
+        return self.clients.get(client_id)
+
+    def values(self):
+        return list(self.clients.values())
+
+    def reserve_id(self):
+        with self._lock:
+            if len(self._free_ids) > 0:
+                return heapq.heappop(self._free_ids)
+
+            client_id = self._next_id
+            self._next_id += self._step
+            return client_id
+
+    def add(self, client):
+        self.clients[client.id] = client
+
+    def remove(self, client):
+        # Returns True if the client was registered. Only the first caller for a client gets True.
+        if self.clients.pop(client.id, None) is not client:
+            return False
+
+        with self._lock:
+            heapq.heappush(self._free_ids, client.id)
+        return True
 
 
 class Server(Thread):
-    def __init__(self, port=6112, iface=''):
+    def __init__(self, port=6112, iface='', reuse_port=False):
         self.port = port
         self.iface = iface
 
         self.out_format = "Client #%client_id: %message"
         self.debug_format = "DEBUG [%client_id]: %message"
+        self.output = None
+
+        # Console output goes to stdout unless a file is set. Files are rotated once they reach log_max_bytes, if set.
+        self.log_file = None
+        self.log_max_bytes = 0
+        self.log_backups = 3
+        self.log_json = False
         self.debug = False
         self.encoding_errors = 'namereplace' if self.debug else 'replace'
         self.ignore_unsupported_commands = False
         self.do_version_check = False
 
+        # Limits for BNCS packets held back to be sent together
+        self.flush_threshold = 16384    # bytes
+        self.flush_delay = 0.05         # seconds
+
+        self.capi_endpoint = None       # The public chat API is used if this isn't set
+
+        # Chat API connections kept open ahead of time for new clients, if more than 0
+        self.capi_pool_size = 0
+        self.capi_pool = None
+
+        # If set, sessions that lose their chat API connection reconnect instead of disconnecting their clients
+        self.capi_reconnect = False
+
+        # If set, clients that log on with the same API key share one chat API session
+        self.share_sessions = False
+        self.sessions = {}          # API key -> CapiClient
+        self.sessions_lock = Lock()
+
+        # Rate limit for chat messages and moderation requests sent to the chat API, per session
+        self.capi_rate = 2.0        # per second, lowered automatically if the API reports a rate limit
+        self.capi_burst = 5
+
+        # New clients are accepted right away and connected to the chat API in the background, 'setup_workers' at a
+        #   time. Once 'max_setups' are waiting or connecting, more clients are turned away until some have finished.
+        self.backlog = 128
+        self.setup_workers = 32
+        self.max_setups = 256
+        self.setups = 0
+        self._setup_lock = Lock()
+
+        # Limits for BNCS packets waiting to be written to a client, and what to do when they are reached
+        self.queue_max_bytes = 262144
+        self.queue_max_packets = 4096
+        self.queue_policy = "disconnect"
+
         self.socket = socket(AF_INET, SOCK_STREAM)
+        if reuse_port:
+            # Lets several processes listen on the same port, with connections shared between them (not on Windows)
+            from socket import SO_REUSEPORT
+            self.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.bind((iface, port))
-        self.socket.listen(5)
 
-        self.clients = {}
+        self.clients = ClientRegistry()
+        self.request_stats = RequestStats()
+
+        # Totals from clients that have disconnected, and how many were closed for each reason
+        self.closed_totals = {}
+        self.close_reasons = {}
+        self._stats_lock = Lock()
+
+        self.scheduler = Scheduler(self.timer_failed)
+        self.monitor = None
+
+        super().__init__()
+
+    @property
+    def out_format(self):
+        return self._out_template.source
+
+    @out_format.setter
+    def out_format(self, value):
+        self._out_template = Template(value)
 
-        self.lock = Lock()
+    @property
+    def debug_format(self):
+        return self._debug_template.source
 
+    @debug_format.setter
+    def debug_format(self, value):
+        self._debug_template = Template(value)
+
+    def start(self):
+        self.output = LogSink(self.log_file, self.log_max_bytes, self.log_backups, self.log_json)
+        self.output.start()
+        self.socket.listen(self.backlog)
+        super().start()
+
+    def print(self, text):
+        # Prints a server message as-is
+        if self.output is None:
+            print(text)
+        else:
+            self.output.write("server", None, None, text)
+
+    def timer_failed(self, ex):
+        # Reports a scheduled callback that raised an exception, with the traceback when debugging
+        self.print("[Server] ERROR! Timer callback failed: %s" % ex)
+        if self.debug:
+            self.print(traceback.format_exc().rstrip())
+
+    def write_client_message(self, client, text, debug=False):
+        template = self._debug_template if debug else self._out_template
+        if self.output is None:
+            print(self.format_message(client, template, text))
+        else:
+            self.output.write("debug" if debug else "info", template, client, text)
+
+    def run(self):
         # Setup and start the thread for checking connection status
-        self.monitor = Thread(target=self._check_connections)
+        self.monitor = Thread(target=self.scheduler.run)
         self.monitor.daemon = True
         self.monitor.start()
 
-        super().__init__()
+        if self.capi_pool_size > 0:
+            self.capi_pool = CapiPool(self.capi_endpoint or DEFAULT_ENDPOINT, self.capi_pool_size)
+            self.capi_pool.start()
 
-    def run(self):
-        print("[Server] ThinBNCS server started - listening on port %i" % self.port)
+        # Chat API handshakes are made by these threads, so a slow one doesn't hold up accepting other clients
+        setup_queue = SimpleQueue()
+        for _ in range(self.setup_workers):
+            thread = Thread(target=self._setup_clients, args=(setup_queue,))
+            thread.daemon = True
+            thread.start()
+
+        self.print("[Server] ThinBNCS server started - listening on port %i" % self.port)
         while True:
             (client, address) = self.socket.accept()
-            obj = Client(self, client, address, self.get_client_id())
-            self.clients[obj.id] = obj
+            obj = Client(self, client, address, self.clients.reserve_id())
+            self.clients.add(obj)
 
             obj.print("Connected from %s" % address[0])
 
-            if obj.capi.connect():
-                obj.bncs.start()
-                obj.capi.start()
+            if self.admit(obj):
+                setup_queue.put((obj, time.monotonic()))
             else:
-                obj.close("Unable to connect to the chat API.")
-
-    def _check_connections(self):
-        last_nulls = datetime.now()
+                self.reject(obj)
 
+    def _setup_clients(self, setup_queue):
         while True:
-            now = datetime.now()
-            send_nulls = (now - last_nulls).total_seconds() > 60
-
-            for c in list(self.clients.values()):
-                # Check for state issue that wasn't caught elsewhere
-                if c.bncs.logged_on and not c.capi.connected():
-                    c.close("Monitor found CAPI disconnected")
-                elif not c.bncs.connected:
-                    c.close("Monitor found BNCS disconnected")
-
-                # Check for idle BNCS connections
-                if c.bncs.connected and c.bncs.last_talk is not None:
-                    idle_time = (now - c.bncs.last_talk).total_seconds()
-                    if idle_time >= 90:
-                        c.close("BNCS client not responding")
-                    elif idle_time >= 30:
-                        c.bncs.send_ping()
-
-                    # Send BNCS NULL packets every minute regardless of activity
-                    if send_nulls:
-                        c.bncs.send(SID_NULL)
-
-                # Check for idle CAPI connections
-                if c.capi.connected() and c.capi.last_talk is not None:
-                    idle_time = (now - c.capi.last_talk).total_seconds()
-                    if idle_time >= 30:
-                        c.close("CAPI server not responding")
-                    else:
-                        c.capi.send_ping()
-
-            if send_nulls:
-                last_nulls = datetime.now()
-
-            time.sleep(10)
-
-    def get_client_id(self):
-        self.lock.acquire()
-
-        x = 1
-        while x in self.clients.keys():
-            x += 1
-
-        self.lock.release()
-        return x
-
-    def format_message(self, client, fmt, message):
-        dt = datetime.now()
-        r = fmt.replace("%message", str(message))
-        r = r.replace("%client_id", str(client.id))
-        r = r.replace("%ip", str(client.address[0]))
-        r = r.replace("%name", str(client.capi.username or ''))
-        r = r.replace("%channel", str(client.capi.channel or ''))
-
-        # For time formatting codes, see: https://docs.python.org/3/library/datetime.html#strftime-strptime-behavior
-        return dt.strftime(r)
+            self._setup_client(*setup_queue.get())
+
+    def _setup_client(self, client, accepted):
+        try:
+            if time.monotonic() - accepted >= SETUP_WAIT_TIMEOUT:
+                self.reject(client)
+            elif client.capi.connect(self.capi_pool):
+                # The client's session can be replaced by a shared one as soon as the BNCS side is started
+                capi = client.capi
+                self.start_timers(client)
+                client.bncs.start()
+                capi.start()
+            else:
+                client.close("Unable to connect to the chat API.")
+        except Exception as ex:
+            client.close("Setup failed: %s" % ex)
+        finally:
+            self.setup_finished()
+
+    def admit(self, client):
+        # Returns False if too many clients are already waiting to be connected to the chat API
+        with self._setup_lock:
+            if self.setups >= self.max_setups:
+                return False
+            self.setups += 1
+            return True
+
+    def setup_finished(self):
+        with self._setup_lock:
+            self.setups -= 1
+
+    @staticmethod
+    def reject(client):
+        # The client's writer must be running for the error to be sent before the connection closes.
+        client.bncs.linger = True
+        if client.bncs.writer is None:
+            client.bncs.start_writer()
+        client.error("The server is busy. Please try again in a moment.")
+        client.close("Server busy")
+
+    def start_timers(self, client):
+        # Each client gets its own deadlines, spread out at random so they don't all fire together.
+        now = time.monotonic()
+        client.timers = [
+            self.scheduler.call_at(now + random.uniform(0, BNCS_NULL_INTERVAL), self._send_null, client),
+            self.scheduler.call_at(self._jitter(now + BNCS_PING_AFTER), self._check_bncs, client),
+            self.scheduler.call_at(self._jitter(now + CAPI_PING_AFTER), self._check_capi, client)
+        ]
+
+    @staticmethod
+    def _jitter(deadline):
+        return deadline + random.uniform(0, TIMER_JITTER)
+
+    # Timer callbacks return the time they should next run, or None once the client is gone.
+    #   Traffic only updates last_talk, and a timer that finds newer traffic moves its own deadline.
+    def _send_null(self, c):
+        if not c.bncs.connected:
+            return None
+
+        # Send BNCS NULL packets every minute regardless of activity
+        c.bncs.send_static(SID_NULL)
+        return self._jitter(time.monotonic() + BNCS_NULL_INTERVAL)
+
+    def _check_bncs(self, c):
+        # Check for state issue that wasn't caught elsewhere
+        if c.bncs.logged_on and not (c.capi.connected() or c.capi.reconnecting):
+            c.close("Monitor found CAPI disconnected")
+            return None
+        elif not c.bncs.connected:
+            c.close("Monitor found BNCS disconnected")
+            return None
+
+        # Check for idle BNCS connections
+        now = time.monotonic()
+        idle_time = now - c.bncs.last_talk
+        if idle_time >= BNCS_TIMEOUT:
+            c.close("BNCS client not responding")
+            return None
+        elif idle_time >= BNCS_PING_AFTER:
+            c.bncs.send_ping()
+            return min(c.bncs.last_talk + BNCS_TIMEOUT, self._jitter(now + BNCS_PING_AFTER))
+        else:
+            return self._jitter(c.bncs.last_talk + BNCS_PING_AFTER)
+
+    def _check_capi(self, c):
+        if not c.capi.connected():
+            if c.capi.reconnecting:
+                # Checked again once it has reconnected
+                return self._jitter(time.monotonic() + CAPI_PING_AFTER)
+
+            # Dealt with by the BNCS check
+            return None
+        elif c.capi.parent is not c:
+            # Another client sharing this session looks after it
+            return self._jitter(time.monotonic() + CAPI_PING_AFTER)
+
+        c.capi.expire_requests(CAPI_REQUEST_TIMEOUT)
+        if not c.capi.connected():
+            return None
+
+        # Check for idle CAPI connections
+        now = time.monotonic()
+        idle_time = now - c.capi.last_talk
+        if idle_time >= CAPI_TIMEOUT:
+            if c.capi.lost("CAPI server not responding"):
+                return self._jitter(now + CAPI_PING_AFTER)
+            return None
+        elif idle_time >= CAPI_PING_AFTER:
+            c.capi.send_ping()
+            return min(c.capi.last_talk + CAPI_TIMEOUT, self._jitter(now + CAPI_PING_AFTER))
+        else:
+            return self._jitter(c.capi.last_talk + CAPI_PING_AFTER)
+
+    def client_closed(self, client, reason):
+        # Keeps the totals from a closed client so they're still included in the server's totals.
+        #   Reasons are grouped by the text before any ':', which is followed by details like exception messages.
+        reason = reason.split(':')[0].strip().rstrip('.') if reason else "Unknown"
+        with self._stats_lock:
+            for key, value in client.counters().items():
+                self.closed_totals[key] = self.closed_totals.get(key, 0) + value
+            self.close_reasons[reason] = self.close_reasons.get(reason, 0) + 1
+
+    def counters(self):
+        """Returns running totals for every client that has connected, including the ones still connected."""
+        with self._stats_lock:
+            totals = dict(self.closed_totals)
+
+        for client in self.clients.values():
+            for key, value in client.counters().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def monitor_active(self):
+        return self.monitor is not None and self.monitor.is_alive()
+
+    @staticmethod
+    def format_message(client, template, message):
+        return template.render(get_fields(client, message, template.fields), time.time())
 
 
 class Client(object):
@@ -117,33 +369,60 @@ class Client(object):
         self.socket = client
         self.address = address
         self.id = client_id
+        self.lock = RLock()
+        self.debugging = server.debug     # Can be changed per client with '/capi debug on|off'
 
         self.bncs = ThinBncsClient(self, client)
-        self.capi = CapiClient(self)
+        self.capi = CapiClient(self, server.capi_endpoint)
+        self.timers = []
 
     def close(self, reason=None):
-        self.server.lock.acquire()
-
-        if self.bncs.connected:
-            self.bncs.socket.close()
-            self.bncs.connected = False
-
-        if self.capi.connected():
-            self.capi.socket.close()
-            self.capi._connected = False
-
-        if self.id in self.server.clients.keys():
-            self.print("Connections closed%s" % ((": " + reason) if reason else ''))
-            del self.server.clients[self.id]
-
-        self.server.lock.release()
+        # Only this client's lock is needed, so closing clients don't wait on each other.
+        with self.lock:
+            for timer in self.timers:
+                timer.cancel()
+
+            if self.bncs.connected:
+                self.bncs.close()
+
+            self.capi.detach(self)
+
+            if self.server.clients.remove(self):
+                self.server.client_closed(self, reason)
+                self.print("Connections closed%s" % ((": " + reason) if reason else ''))
+
+    def counters(self):
+        bncs, capi, queue = self.bncs, self.capi, self.bncs.outbound
+        totals = {
+            "bncs_packets_received": bncs.packets_received,
+            "bncs_bytes_received": bncs.bytes_received,
+            "bncs_packets_sent": queue.sent_packets,
+            "bncs_bytes_sent": queue.sent_bytes,
+            "bncs_packets_dropped": queue.dropped + queue.coalesced,
+            "bncs_handler_seconds": bncs.handler_time
+        }
+
+        # A shared session is only counted for the client looking after it
+        if capi.parent is self:
+            totals.update({
+                "capi_connects": capi.connects,
+                "capi_messages_received": capi.messages_received,
+                "capi_bytes_received": capi.bytes_received,
+                "capi_messages_sent": capi.messages_sent,
+                "capi_bytes_sent": capi.bytes_sent,
+                "capi_handler_seconds": capi.handler_time,
+                "capi_rate_limited": capi.outbox.limited,
+                "capi_requests_rejected": capi.outbox.rejected
+            })
+        return totals
 
     def print(self, text):
-        print(self.server.format_message(self, self.server.out_format, text))
+        self.server.write_client_message(self, text)
 
-    def debug(self, text):
-        if self.server.debug:
-            print(self.server.format_message(self, self.server.debug_format, text))
+    def debug(self, text, *args):
+        # Messages are only formatted with 'args' if debugging is enabled for this client.
+        if self.debugging:
+            self.server.write_client_message(self, (text % args) if args else text, True)
 
     def error(self, message):
         self.bncs.send_error(message)
@@ -8,5 +8,9 @@ setup(
     description='Proxy to allow legacy BNET clients to connect to the chat API',
     author='Davnit',
     author_email='david@davnit.net',
-    install_requires=['websocket-client>=0.53.0']
+    install_requires=['websocket-client>=0.53.0'],
+    extras_require={
+        'asyncio': ['websockets>=14.0'],
+        'fast': ['orjson']
+    }
 )
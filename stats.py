@@ -0,0 +1,70 @@
+
+from threading import Lock
+import bisect
+
+
+class Histogram(object):
+    """Counts observed values into buckets with fixed upper bounds.
+
+    The last bucket has no upper bound. Percentiles are estimated as the upper bound of the bucket they fall into.
+    """
+    default_bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)     # seconds
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds or Histogram.default_bounds
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return (self.sum / self.count) if self.count > 0 else 0.0
+
+    def percentile(self, pct):
+        if self.count == 0:
+            return 0.0
+
+        target = self.count * pct / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def copy(self):
+        h = Histogram(self.bounds)
+        h.buckets = list(self.buckets)
+        h.count, h.sum, h.max = self.count, self.sum, self.max
+        return h
+
+
+class RequestStats(object):
+    """Round-trip times and timeouts of chat API requests, by command. Shared by every client on a server."""
+    def __init__(self):
+        self.lock = Lock()
+        self.latency = {}
+        self.timeouts = {}
+
+    def observe(self, command, seconds):
+        with self.lock:
+            h = self.latency.get(command)
+            if h is None:
+                h = self.latency[command] = Histogram()
+            h.observe(seconds)
+
+    def timed_out(self, command):
+        with self.lock:
+            self.timeouts[command] = self.timeouts.get(command, 0) + 1
+
+    def snapshot(self):
+        """Returns copies of the latency histograms and timeout counts."""
+        with self.lock:
+            return {k: h.copy() for k, h in self.latency.items()}, dict(self.timeouts)
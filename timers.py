@@ -0,0 +1,92 @@
+
+from threading import Condition
+import heapq
+import itertools
+import time
+
+
+class Timer(object):
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """Runs callbacks when their deadlines on the monotonic clock pass.
+
+    A callback can return a new deadline to be run again, or None to stop. Work is only done for timers that are due,
+    so the cost does not depend on how many timers are waiting.
+    """
+    def __init__(self, on_error=None):
+        self.lock = Condition()
+        self.on_error = on_error    # Called with the exception, from inside the handler, when a callback fails
+        self.heap = []
+        self.wakeup = None      # Called when an earlier deadline is added, for runners that don't wait on the lock
+
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _push(self, timer):
+        # Caller must hold the lock
+        heapq.heappush(self.heap, (timer.deadline, next(self._counter), timer))
+        if self.heap[0][2] is timer:
+            self.lock.notify()
+            if self.wakeup:
+                self.wakeup()
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        with self.lock:
+            self._push(timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def next_delay(self):
+        """Returns the number of seconds until the next deadline, or None if there are no timers."""
+        with self.lock:
+            if len(self.heap) == 0:
+                return None
+            return max(self.heap[0][0] - time.monotonic(), 0)
+
+    def run_due(self):
+        while True:
+            with self.lock:
+                if len(self.heap) == 0 or self.heap[0][0] > time.monotonic():
+                    return
+                timer = heapq.heappop(self.heap)[2]
+
+            if timer.cancelled:
+                continue
+
+            try:
+                deadline = timer.callback(*timer.args)
+            except Exception as ex:
+                if self.on_error:
+                    self.on_error(ex)
+                else:
+                    print("[Server] ERROR! Timer callback failed: %s" % ex)
+                deadline = None
+
+            if deadline is not None and not timer.cancelled:
+                timer.deadline = deadline
+                with self.lock:
+                    self._push(timer)
+
+    def run(self):
+        # Runs timers on the calling thread forever.
+        while True:
+            self.run_due()
+
+            with self.lock:
+                timeout = (self.heap[0][0] - time.monotonic()) if len(self.heap) > 0 else None
+                if timeout is None or timeout > 0:
+                    self.lock.wait(timeout)
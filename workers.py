@@ -0,0 +1,240 @@
+
+# Runs several server processes on the same port, so that more than one CPU core can be used.
+#   Each worker binds the port with SO_REUSEPORT and the kernel shares new connections between them. The supervisor
+#   restarts workers that exit and combines their metrics. This needs fork() and SO_REUSEPORT, so it isn't available
+#   on Windows.
+#
+# The supervisor only has one thread, and handles metrics requests between checks on the workers. Forking while other
+#   threads are running could leave a new worker with a copy of a lock that is never released.
+
+import metrics
+from server import ClientRegistry
+
+from threading import Thread
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+
+RESTART_DELAY = 1           # Seconds before restarting a worker, doubled each time it exits soon after starting
+RESTART_DELAY_MAX = 30
+STABLE_AFTER = 10           # Seconds a worker must run for its restart delay to be reset
+
+STATS_LENGTH = struct.Struct('<L')
+
+
+def supported():
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+
+def serve_stats(sock, server):
+    # Runs in a worker, sending its metrics to the supervisor whenever asked.
+    while sock.recv(1):
+        data = metrics.collect(server).encode('utf-8')
+        sock.sendall(STATS_LENGTH.pack(len(data)) + data)
+
+
+class Worker(object):
+    def __init__(self, number):
+        self.number = number
+        self.pid = None
+        self.started = None
+        self.restart_at = 0
+        self.delay = RESTART_DELAY
+        self.restarts = 0
+
+        self.stats = None           # The supervisor's end of a socket pair for getting metrics from the worker
+        self.stats_buffer = None    # Data received from the worker that isn't a whole reply yet
+        self.stats_waiting = 0      # Requests sent to the worker that haven't been answered
+
+    def read_stats(self):
+        # Asks the worker for its metrics and returns them. A reply that didn't arrive in time for an earlier request
+        #   is read and thrown away first, so the replies stay in step with the requests.
+        self.stats.sendall(b'?')
+        self.stats_waiting += 1
+
+        buffer = self.stats_buffer
+        while True:
+            if len(buffer) >= STATS_LENGTH.size:
+                end = STATS_LENGTH.size + STATS_LENGTH.unpack_from(buffer)[0]
+                if len(buffer) >= end:
+                    data = bytes(buffer[STATS_LENGTH.size:end])
+                    del buffer[:end]
+                    self.stats_waiting -= 1
+                    if self.stats_waiting == 0:
+                        return data.decode('utf-8')
+                    continue
+
+            chunk = self.stats.recv(65536)
+            if not chunk:
+                raise ConnectionError("Worker closed the stats connection")
+            buffer.extend(chunk)
+
+
+class Supervisor(object):
+    """Starts and watches over 'count' worker processes.
+
+    'build' is called in each new worker process with the worker's number, and returns a configured server that
+    hasn't been started yet. It must be created with reuse_port=True.
+    """
+    def __init__(self, count, build):
+        self.count = count
+        self.build = build
+        self.workers = [Worker(i) for i in range(count)]
+        self.metrics_address = None
+
+        self._httpd = None
+
+    def print(self, text):
+        print(text, flush=True)
+
+    def start_worker(self, worker):
+        parent_end, child_end = socket.socketpair()
+
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            code = 1
+            try:
+                code = self._run_worker(worker, child_end)
+            except BaseException as ex:
+                sys.stderr.write("[Worker #%i] ERROR! %s: %s\n" % (worker.number, type(ex).__name__, ex))
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+
+        child_end.close()
+        parent_end.settimeout(5)
+        worker.pid = pid
+        worker.started = time.monotonic()
+        worker.stats = parent_end
+        worker.stats_buffer = bytearray()
+        worker.stats_waiting = 0
+
+    def _run_worker(self, worker, stats):
+        # Runs in the new process. Things that belong to the supervisor are closed first.
+        #   Ctrl+C is left to the supervisor, which stops every worker.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self._httpd is not None:
+            self._httpd.socket.close()
+        for other in self.workers:
+            if other.stats is not None:
+                other.stats.close()
+
+        server = self.build(worker.number)
+        server.clients = ClientRegistry(worker.number + 1, self.count)     # So client IDs are unique across workers
+
+        thread = Thread(target=serve_stats, args=(stats, server))
+        thread.daemon = True
+        thread.start()
+
+        server.start()
+        server.join()
+        return 1        # The server should never stop by itself
+
+    def collect(self):
+        texts = []
+        for worker in self.workers:
+            if worker.stats is None:
+                continue
+            try:
+                texts.append(worker.read_stats())
+            except (OSError, UnicodeDecodeError):
+                # Left out of this scrape. Anything still to come from a slow worker is skipped next time.
+                continue
+
+        lines = [
+            "# HELP capidaptor_workers Running worker processes",
+            "# TYPE capidaptor_workers gauge",
+            "capidaptor_workers %s" % repr(float(sum(1 for w in self.workers if w.pid is not None))),
+            "# HELP capidaptor_worker_restarts_total Worker processes restarted after exiting",
+            "# TYPE capidaptor_worker_restarts_total counter",
+            "capidaptor_worker_restarts_total %s" % repr(float(sum(w.restarts for w in self.workers)))
+        ]
+        return '\n'.join(lines) + '\n' + metrics.combine(texts)
+
+    def _reap(self, pid, status):
+        worker = next((w for w in self.workers if w.pid == pid), None)
+        if worker is None:
+            return
+
+        worker.stats.close()
+        worker.stats = None
+        worker.pid = None
+
+        # Back off if it keeps exiting right away
+        now = time.monotonic()
+        if now - worker.started >= STABLE_AFTER:
+            worker.delay = RESTART_DELAY
+        else:
+            worker.delay = min(worker.delay * 2, RESTART_DELAY_MAX)
+        worker.restart_at = now + worker.delay
+
+        if os.WIFSIGNALED(status):
+            how = "was killed by signal %i" % os.WTERMSIG(status)
+        else:
+            how = "exited with code %i" % os.WEXITSTATUS(status)
+        self.print("[Server] Worker #%i (pid %i) %s - restarting in %i seconds" % (worker.number, pid, how,
+                                                                                 worker.delay))
+
+    def run(self):
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop)
+
+        for worker in self.workers:
+            self.start_worker(worker)
+        self.print("[Server] Started %i worker processes" % self.count)
+
+        if self.metrics_address:
+            self._httpd = metrics.create(self.metrics_address, self.collect, threaded=False)
+            self.print("[Server] Metrics available at %s" % self.metrics_address)
+
+        try:
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    pid, status = 0, 0
+
+                if pid != 0:
+                    self._reap(pid, status)
+                    continue
+
+                now = time.monotonic()
+                for worker in self.workers:
+                    if worker.pid is None and worker.restart_at <= now:
+                        worker.restarts += 1
+                        self.start_worker(worker)
+                self._wait(0.25)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _wait(self, timeout):
+        # Waits for up to 'timeout' seconds, answering a metrics request if one comes in
+        if self._httpd is None:
+            time.sleep(timeout)
+        elif select.select([self._httpd], [], [], timeout)[0]:
+            self._httpd.handle_request()
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.waitpid(worker.pid, 0)
+                except ChildProcessError:
+                    pass
+                worker.pid = None
+        self.print("[Server] All workers stopped")